@@ -66,10 +66,13 @@ module KBaseReportPy {
      *        Report object (see KBaseReportWorkspace.spec)
      *    string name - Plaintext unique name for the report. In
      *        create_extended, this can optionally be set in a parameter
+     *    mapping<string, float> debug - Seconds spent in each stage of creating
+     *        the report. Only returned when the debug parameter is set to 1
      */
     typedef structure {
         ws_id ref;
         string name;
+        mapping<string, float> debug;
     } ReportInfo;
 
     /*
@@ -129,6 +132,15 @@ module KBaseReportPy {
      *         be auto-generated if unspecified)
      *     html_window_height - Fixed height in pixels of the HTML window for the report
      *     summary_window_height - Fixed height in pixels of the summary window for the report
+     *     int debug - Set to 1 to return the time spent in each stage of creating the report
+     *         (validation, zipping, uploads, workspace lookup and save) in ReportInfo
+     *     string idempotency_key - Key identifying this report across retries. When creating
+     *         a report fails part of the way through, a retry with the same key only uploads
+     *         the paths that weren't uploaded yet. Defaults to a key derived from the parameters
+     *     int idempotent - Set to 1 to return the existing report instead of saving a new one
+     *         when the report named report_object_name (which is then required) was saved from
+     *         the same parameters and file contents. Used by create_extended_report and
+     *         create_extended_report_submit
      */
     typedef structure {
         string message;
@@ -143,6 +155,9 @@ module KBaseReportPy {
         float summary_window_height;
         string workspace_name;
         int workspace_id;
+        int debug;
+        string idempotency_key;
+        int idempotent;
     } CreateExtendedReportParams;
 
     /*
@@ -151,4 +166,54 @@ module KBaseReportPy {
      */
     funcdef create_extended_report(CreateExtendedReportParams params)
         returns (ReportInfo info) authentication required;
+
+    /*
+     * Create many reports at once, such as one report per sample in a batch app.
+     * Takes a list of the same parameters as create_extended_report.
+     * Every report is validated before any files are uploaded, files for all reports are
+     * uploaded together, and the reports are saved with as few workspace calls as possible.
+     * Returns a ReportInfo for each report, in the same order as the parameters.
+     * idempotency_key and idempotent are not supported here, and are rejected.
+     */
+    funcdef create_extended_reports(list<CreateExtendedReportParams> params)
+        returns (list<ReportInfo> infos) authentication required;
+
+    /*
+     * Start creating an extended report in the background, and return a job ID right away.
+     * Takes the same parameters as create_extended_report, which are validated before the job
+     * starts. Use check_report_job to follow the progress of the job and to get its ReportInfo.
+     */
+    funcdef create_extended_report_submit(CreateExtendedReportParams params)
+        returns (string job_id) authentication required;
+
+    /*
+     * The status of a job started with create_extended_report_submit
+     * Returned data:
+     *     string job_id - ID of the job
+     *     string status - One of "queued", "running", "completed" or "error"
+     *     int files_done, files_total - Number of file and HTML links that
+     *         have been uploaded or linked, out of the total
+     *     int bytes_done, bytes_total - Bytes of the file and HTML link paths
+     *         uploaded, out of the total
+     *     ReportInfo result - The created report, when status is "completed"
+     *     string error - Error message, when status is "error"
+     */
+    typedef structure {
+        string job_id;
+        string status;
+        int files_done;
+        int files_total;
+        int bytes_done;
+        int bytes_total;
+        ReportInfo result;
+        string error;
+    } ReportJobStatus;
+
+    /*
+     * Get the status and upload progress of a job started with create_extended_report_submit.
+     * Once the job has completed or failed, its status (with its ReportInfo or error) is
+     * returned by one call only, and the job is forgotten.
+     */
+    funcdef check_report_job(string job_id)
+        returns (ReportJobStatus status) authentication required;
 };
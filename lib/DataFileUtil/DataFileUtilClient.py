@@ -27,7 +27,7 @@ class DataFileUtil(object):
             auth_svc='https://kbase.us/services/authorization/Sessions/Login',
             service_ver='release',
             async_job_check_time_ms=100, async_job_check_time_scale_percent=150, 
-            async_job_check_max_time_ms=300000):
+            async_job_check_max_time_ms=300000, pool_size=10):
         if url is None:
             raise ValueError('A url is required')
         self._service_ver = service_ver
@@ -38,7 +38,8 @@ class DataFileUtil(object):
             auth_svc=auth_svc,
             async_job_check_time_ms=async_job_check_time_ms,
             async_job_check_time_scale_percent=async_job_check_time_scale_percent,
-            async_job_check_max_time_ms=async_job_check_max_time_ms)
+            async_job_check_max_time_ms=async_job_check_max_time_ms,
+            pool_size=pool_size)
 
     def _check_job(self, job_id):
         return self._client._check_job('DataFileUtil', job_id)
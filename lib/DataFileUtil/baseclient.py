@@ -7,8 +7,8 @@
 
 from __future__ import print_function
 
-import json as _json
 import requests as _requests
+from requests.adapters import HTTPAdapter as _HTTPAdapter
 import random as _random
 import os as _os
 
@@ -23,6 +23,11 @@ except ImportError:
     from urlparse import urlparse as _urlparse  # py2
 import time
 
+try:
+    from .jsoncodec import dumps as _json_dumps, loads as _json_loads
+except ImportError:
+    from jsoncodec import dumps as _json_dumps, loads as _json_loads
+
 _CT = 'content-type'
 _AJ = 'application/json'
 _URL_SCHEME = frozenset(['http', 'https'])
@@ -39,7 +44,7 @@ def _get_token(user_id, password, auth_svc):
     ret = _requests.post(auth_svc, data=body, allow_redirects=True)
     status = ret.status_code
     if status >= 200 and status <= 299:
-        tok = _json.loads(ret.text)
+        tok = _json_loads(ret.text)
     elif status == 403:
         raise Exception('Authentication failed: Bad user_id/password ' +
                         'combination for user %s' % (user_id))
@@ -83,16 +88,6 @@ class ServerError(Exception):
             '\n' + self.data
 
 
-class _JSONObjectEncoder(_json.JSONEncoder):
-
-    def default(self, obj):
-        if isinstance(obj, set):
-            return list(obj)
-        if isinstance(obj, frozenset):
-            return list(obj)
-        return _json.JSONEncoder.default(self, obj)
-
-
 class BaseClient(object):
     '''
     The KBase base client.
@@ -116,6 +111,8 @@ class BaseClient(object):
     lookup_url - set to true when contacting KBase dynamic services.
     async_job_check_time_ms - the wait time between checking job state for
         asynchronous jobs run with the run_job method.
+    pool_size - the maximum number of keep-alive connections to the service
+        that are kept open for reuse. The client can be shared between threads.
     '''
     def __init__(
             self, url=None, timeout=30 * 60, user_id=None,
@@ -125,7 +122,8 @@ class BaseClient(object):
             lookup_url=False,
             async_job_check_time_ms=100,
             async_job_check_time_scale_percent=150,
-            async_job_check_max_time_ms=300000):
+            async_job_check_max_time_ms=300000,
+            pool_size=10):
         if url is None:
             raise ValueError('A url is required')
         scheme, _, _, _, _, _ = _urlparse(url)
@@ -159,6 +157,12 @@ class BaseClient(object):
                         authdata['user_id'], authdata['password'], auth_svc)
         if self.timeout < 1:
             raise ValueError('Timeout value must be at least 1 second')
+        # Reuse connections across calls. The session is only configured here, so it can be
+        # used by many threads at once.
+        self._session = _requests.Session()
+        adapter = _HTTPAdapter(pool_maxsize=pool_size)
+        self._session.mount('http://', adapter)
+        self._session.mount('https://', adapter)
 
     def _call(self, url, method, params, context=None):
         arg_hash = {'method': method,
@@ -171,14 +175,14 @@ class BaseClient(object):
                 raise ValueError('context is not type dict as required.')
             arg_hash['context'] = context
 
-        body = _json.dumps(arg_hash, cls=_JSONObjectEncoder)
-        ret = _requests.post(url, data=body, headers=self._headers,
-                             timeout=self.timeout,
-                             verify=not self.trust_all_ssl_certificates)
+        body = _json_dumps(arg_hash)
+        ret = self._session.post(url, data=body, headers=self._headers,
+                                 timeout=self.timeout,
+                                 verify=not self.trust_all_ssl_certificates)
         ret.encoding = 'utf-8'
         if ret.status_code == 500:
             if ret.headers.get(_CT) == _AJ:
-                err = ret.json()
+                err = _json_loads(ret.text)
                 if 'error' in err:
                     raise ServerError(**err['error'])
                 else:
@@ -187,7 +191,7 @@ class BaseClient(object):
                 raise ServerError('Unknown', 0, ret.text)
         if not ret.ok:
             ret.raise_for_status()
-        resp = ret.json()
+        resp = _json_loads(ret.text)
         if 'result' not in resp:
             raise ServerError('Unknown', 0, 'An unknown server error occurred')
         if not resp['result']:
@@ -1,8 +1,19 @@
 # -*- coding: utf-8 -*-
 #BEGIN_HEADER
 from DataFileUtil.DataFileUtilClient import DataFileUtil
+from Workspace.WorkspaceClient import Workspace
 import utils.report_utils as report_utils
 from utils.validation_utils import validate_simple_report_params, validate_extended_report_params
+from utils.validation_utils import validate_extended_reports_params, validate_report_size
+from utils.dir_scan import DirScanner
+from utils.file_utils import estimate_size
+from utils.metrics import Metrics
+from utils.report_jobs import ReportJobs
+from utils.report_ref_cache import ReportRefCache
+from utils.timing_utils import StageHistograms, StageTimer, seconds_by_stage
+from utils.upload_cache import UploadCache
+from utils.upload_journal import open_journal, remove_expired
+from utils.workspace_cache import WorkspaceIdCache
 import os
 #END_HEADER
 
@@ -27,6 +38,90 @@ class KBaseReportPy:
     GIT_COMMIT_HASH = "e3ae8dbb0802480eabad8330974e91f5bdac95bd"
 
     #BEGIN_CLASS_HEADER
+    def _log_timings(self, ctx, method, timer):
+        """
+        Log the time spent in each stage of a call, and add it to the histograms in status()
+        and to the metrics
+        :return: the timer's breakdown
+        """
+        breakdown = timer.breakdown()
+        self.timing_histograms.observe(breakdown)
+        self.metrics.inc('kbase_report_uploaded_bytes_total',
+                         timer.totals.get('uploaded_bytes', 0))
+        ctx.log_info(method + ' timings: ' + timer.format(breakdown))
+        return breakdown
+
+    def _check_size(self, ctx, method, params, scanner):
+        """
+        Count the bytes and files in the paths of a report before anything is uploaded, log them,
+        and reject the report if they are over max-report-bytes or max-report-files
+        :param scanner: DirScanner for the report, which keeps the scans for the uploads
+        """
+        size = estimate_size(params.get('file_links', []), params.get('html_links', []),
+                             scanner)
+        # Link names may not be ASCII, so the line is built as unicode and logged as UTF-8
+        message = u'%s size: total=%dB/%d' % (method, size['bytes'], size['files'])
+        for link in size['links']:
+            name = link['name']
+            if isinstance(name, str):
+                name = name.decode('utf-8', 'replace')
+            message += u' %s=%dB/%d' % (name, link['bytes'], link['files'])
+        ctx.log_info(message.encode('utf-8'))
+        self.metrics.observe('kbase_report_bytes', size['bytes'])
+        validate_report_size(params, size, self.max_report_bytes, self.max_report_files)
+
+    def _create_extended_report(self, ctx, params, timer, progress=None, scanner=None,
+                                preflight=None):
+        """
+        Create an extended report from validated params, for create_extended_report and for
+        jobs started by create_extended_report_submit
+        :param progress: optional JobProgress (see utils/report_jobs.py) for the upload progress
+        :param scanner: DirScanner that already scanned the report's paths (see _check_size)
+        :param preflight: optional function checking the report's paths (see _check_size),
+            which runs alongside the workspace lookup
+        :return: ReportInfo
+        """
+        (info, meta, ref_key) = (None, None, None)
+        # Each path is walked, and hashed if needed, once for the whole report
+        if scanner is None:
+            scanner = DirScanner(self.scan_threads, timer)
+        if params.get('idempotent'):
+            if preflight is not None:
+                # Don't hash the files of a report that is too large
+                preflight()
+                preflight = None
+            # Return the report saved from the same params and files, if there is one
+            params_hash = report_utils.report_hash(params, scanner)
+            meta = {report_utils.REPORT_HASH_META_KEY: params_hash}
+            ref_key = (ctx.get('user_id'), params.get('workspace_name'),
+                       params.get('workspace_id'), params['report_object_name'], params_hash)
+            ref = self.report_ref_cache.get(ref_key)
+            if ref is None:
+                ws = Workspace(self.workspace_url, token=ctx['token'])
+                ref = report_utils.find_report(timer.wrap(ws), params, params_hash)
+            if ref is not None:
+                info = {'ref': ref, 'name': params['report_object_name']}
+        if info is None:
+            journal = None
+            if self.upload_journal_max_age_sec > 0:
+                journal = open_journal(self.upload_journal_dir, ctx.get('user_id'), params,
+                                       params.get('idempotency_key'))
+            info = report_utils.create_extended(params, timer.wrap(self.dfu),
+                                                self.upload_threads, self.upload_batch_size,
+                                                self.upload_cache, self.ws_cache, timer,
+                                                progress, journal, meta, scanner,
+                                                self.scratch, preflight)
+            if journal is not None:
+                # Retries of a report that was saved start over
+                journal.remove()
+            self.metrics.observe('kbase_report_files', len(params.get('file_links', [])) +
+                                 len(params.get('html_links', [])))
+        if ref_key is not None:
+            self.report_ref_cache.add(ref_key, info['ref'])
+        breakdown = self._log_timings(ctx, 'create_extended_report', timer)
+        if params.get('debug'):
+            info['debug'] = seconds_by_stage(breakdown)
+        return info
     #END_CLASS_HEADER
 
     # config contains contents of config file in a hash or None if it couldn't
@@ -35,7 +130,66 @@ class KBaseReportPy:
         #BEGIN_CONSTRUCTOR
         self.callback_url = os.environ['SDK_CALLBACK_URL']
         self.scratch = config['scratch']
-        self.dfu = DataFileUtil(self.callback_url)
+        # Keep-alive connections to the callback server, shared by concurrent uploads
+        self.dfu = DataFileUtil(self.callback_url,
+                                pool_size=int(config.get('http-pool-size', 10)))
+        # Number of file uploads that can run at the same time for a single report
+        self.upload_threads = int(config.get('upload-threads', 4))
+        # Number of file paths to send in each DataFileUtil.file_to_shock_mass call
+        # A value of 0 uploads every path with its own file_to_shock call
+        self.upload_batch_size = int(config.get('upload-batch-size', 0))
+        # Persistent cache of uploaded file digests, so identical files are not re-uploaded
+        # Setting upload-cache-max-entries to 0 disables the cache
+        self.upload_cache = None
+        cache_size = int(config.get('upload-cache-max-entries', 0))
+        if cache_size > 0:
+            self.upload_cache = UploadCache(
+                os.path.join(self.scratch, 'upload_cache.json'),
+                maxsize=cache_size,
+                max_age_sec=int(config.get('upload-cache-max-age-sec', 24 * 60 * 60)))
+        # Number of threads that list directories and hash files for a single report
+        self.scan_threads = int(config.get('scan-threads', 8))
+        # Reports whose paths hold more bytes or files than these are rejected before any
+        # upload starts. A limit of 0 is no limit.
+        self.max_report_bytes = int(config.get('max-report-bytes', 0))
+        self.max_report_files = int(config.get('max-report-files', 0))
+        # Journals of the uploads done for each extended report, so that retrying a report that
+        # failed part of the way through doesn't upload its files again
+        # Setting upload-journal-max-age-sec to 0 disables the journals
+        self.upload_journal_dir = os.path.join(self.scratch, 'upload_journals')
+        self.upload_journal_max_age_sec = int(config.get('upload-journal-max-age-sec',
+                                                         24 * 60 * 60))
+        if self.upload_journal_max_age_sec > 0:
+            remove_expired(self.upload_journal_dir, self.upload_journal_max_age_sec)
+        # Reports saved in idempotent mode are looked up in the workspace, and cached here
+        self.workspace_url = config.get('workspace-url')
+        self.report_ref_cache = ReportRefCache(
+            maxsize=int(config.get('report-ref-cache-max-entries', 1000)),
+            ttl_sec=int(config.get('report-ref-cache-ttl-sec', 10 * 60)))
+        # Cache of workspace name to ID lookups
+        self.ws_cache = WorkspaceIdCache(
+            maxsize=int(config.get('workspace-cache-max-entries', 1000)),
+            ttl_sec=int(config.get('workspace-cache-ttl-sec', 5 * 60)))
+        # Validate extended report params with the single-pass validator instead of cerberus
+        self.fast_validation = config.get('fast-validation') == 'true'
+        # Time spent in each stage of creating reports, over every call (see status)
+        self.timing_histograms = StageHistograms()
+        # Metrics about the reports themselves; the server adds these to its own metrics
+        self.metrics = Metrics()
+        self.metrics.counter('kbase_report_uploaded_bytes_total',
+                             'Bytes of report files uploaded to shock')
+        self.metrics.histogram('kbase_report_files', 'Number of file and HTML links per report',
+                               buckets=(0, 1, 2, 5, 10, 20, 50, 100, 200, 500, 1000))
+        self.metrics.histogram('kbase_report_bytes', 'Bytes in the paths of each report',
+                               buckets=tuple(10 ** exp for exp in range(3, 12)))
+        # Jobs started by create_extended_report_submit, and the number of them that can run at
+        # the same time in each process. Their state is kept in a file per job under
+        # report-job-dir, so check_report_job can be served by any process that shares it.
+        # Results that are never checked are dropped after report-job-ttl-sec.
+        self.report_jobs = ReportJobs(
+            config.get('report-job-dir') or os.path.join(self.scratch, 'report_jobs'),
+            max_workers=int(config.get('report-job-threads', 2)),
+            ttl_sec=int(config.get('report-job-ttl-sec', 60 * 60)))
         #END_CONSTRUCTOR
         pass
 
@@ -81,17 +235,23 @@ class KBaseReportPy:
            'workspace_id/object_id/version'. This is a reference to a saved *
            Report object (see KBaseReportWorkspace.spec) *    string name -
            Plaintext unique name for the report. In *        create_extended,
-           this can optionally be set in a parameter) -> structure: parameter
-           "ref" of type "ws_id" (* Workspace ID reference in the format
-           'workspace_id/object_id/version' * @id ws), parameter "name" of
-           String
+           this can optionally be set in a parameter *    mapping<string,
+           float> debug - Seconds spent in each stage of creating *       
+           the report. Only returned when the debug parameter is set to 1) ->
+           structure: parameter "ref" of type "ws_id" (* Workspace ID
+           reference in the format 'workspace_id/object_id/version' * @id
+           ws), parameter "name" of String, parameter "debug" of mapping from
+           String to Double
         """
         # ctx is the context object
         # return variables are: info
         #BEGIN create
+        timer = StageTimer()
         # Validate params
-        params = validate_simple_report_params(params)
-        info = report_utils.create_report(params, self.dfu)
+        with timer.time('validate'):
+            params = validate_simple_report_params(params)
+        info = report_utils.create_report(params, timer.wrap(self.dfu), self.ws_cache)
+        self._log_timings(ctx, 'create', timer)
         #END create
 
         # At some point might do deeper type checking...
@@ -135,7 +295,19 @@ class KBaseReportPy:
            (will *         be auto-generated if unspecified) *    
            html_window_height - Fixed height in pixels of the HTML window for
            the report *     summary_window_height - Fixed height in pixels of
-           the summary window for the report) -> structure: parameter
+           the summary window for the report *     int debug - Set to 1 to
+           return the time spent in each stage of creating the report *      
+           (validation, zipping, uploads, workspace lookup and save) in
+           ReportInfo *     string idempotency_key - Key identifying this
+           report across retries. When creating *         a report fails part
+           of the way through, a retry with the same key only uploads *      
+           the paths that weren't uploaded yet. Defaults to a key derived
+           from the parameters *     int idempotent - Set to 1 to return the
+           existing report instead of saving a new one *         when the
+           report named report_object_name (which is then required) was saved
+           from *         the same parameters and file contents. Used by
+           create_extended_report and *         create_extended_report_submit)
+           -> structure: parameter
            "message" of String, parameter "objects_created" of list of type
            "WorkspaceObject" (* Represents a Workspace object with some brief
            description text * that can be associated with the object. *
@@ -173,7 +345,8 @@ class KBaseReportPy:
            String, parameter "report_object_name" of String, parameter
            "html_window_height" of Double, parameter "summary_window_height"
            of Double, parameter "workspace_name" of String, parameter
-           "workspace_id" of Long
+           "workspace_id" of Long, parameter "debug" of Long, parameter
+           "idempotency_key" of String, parameter "idempotent" of Long
         :returns: instance of type "ReportInfo" (* The reference to the saved
            KBaseReport. This is the return object for * both create() and
            create_extended() * Returned data: *    ws_id ref - reference to a
@@ -181,16 +354,24 @@ class KBaseReportPy:
            'workspace_id/object_id/version'. This is a reference to a saved *
            Report object (see KBaseReportWorkspace.spec) *    string name -
            Plaintext unique name for the report. In *        create_extended,
-           this can optionally be set in a parameter) -> structure: parameter
-           "ref" of type "ws_id" (* Workspace ID reference in the format
-           'workspace_id/object_id/version' * @id ws), parameter "name" of
-           String
+           this can optionally be set in a parameter *    mapping<string,
+           float> debug - Seconds spent in each stage of creating *       
+           the report. Only returned when the debug parameter is set to 1) ->
+           structure: parameter "ref" of type "ws_id" (* Workspace ID
+           reference in the format 'workspace_id/object_id/version' * @id
+           ws), parameter "name" of String, parameter "debug" of mapping from
+           String to Double
         """
         # ctx is the context object
         # return variables are: info
         #BEGIN create_extended_report
-        params = validate_extended_report_params(params)
-        info = report_utils.create_extended(params, self.dfu)
+        timer = StageTimer()
+        with timer.time('validate'):
+            params = validate_extended_report_params(params, self.fast_validation)
+        scanner = DirScanner(self.scan_threads, timer)
+        info = self._create_extended_report(
+            ctx, params, timer, scanner=scanner,
+            preflight=lambda: self._check_size(ctx, 'create_extended_report', params, scanner))
         #END create_extended_report
 
         # At some point might do deeper type checking...
@@ -199,6 +380,305 @@ class KBaseReportPy:
                              'info is not type dict as required.')
         # return the results
         return [info]
+
+    def create_extended_reports(self, ctx, params):
+        """
+        Create many reports at once, such as one report per sample in a batch
+        app. Takes a list of the same parameters as create_extended_report.
+        Every report is validated before any files are uploaded, files for all
+        reports are uploaded together, and the reports are saved with as few
+        workspace calls as possible. Returns a ReportInfo for each report, in
+        the same order as the parameters. idempotency_key and idempotent are
+        not supported here, and are rejected.
+        :param params: instance of list of type "CreateExtendedReportParams" (*
+           Parameters used to create a more complex report with file and HTML
+           links * * Pass in *either* workspace_name or workspace_id -- only
+           one is needed. * Note that workspace_id is preferred over
+           workspace_name because workspace_id immutable. * * Required
+           arguments: *     string workspace_name - Name of the workspace
+           where the report *         should be saved. Required if
+           workspace_id is absent *     int workspace_id - ID of workspace
+           where the report should be saved. *         Required if
+           workspace_name is absent * Optional arguments: *     string
+           message - Simple text message to store in the report object *    
+           list<WorkspaceObject> objects_created - List of result workspace
+           objects that this app *         has created. They will be linked
+           in the report view *     list<string> warnings - A list of
+           plain-text warning messages *     list<File> html_links - A list
+           of paths or shock IDs pointing to HTML files or directories. *    
+           If you pass in paths to directories, they will be zipped and
+           uploaded *     int direct_html_link_index - Index in html_links to
+           set the direct/default view in the *         report. Set either
+           direct_html_link_index or direct_html, but not both *     string
+           direct_html - Simple HTML text content that will be rendered
+           within the report *         widget. Set either direct_html or
+           direct_html_link_index, but not both *     list<File> file_links -
+           A list of file paths or shock node IDs. Allows the user to *      
+           specify files that the report widget should link for download. If
+           you pass in paths *         to directories, they will be zipped * 
+           string report_object_name - Name to use for the report object
+           (will *         be auto-generated if unspecified) *    
+           html_window_height - Fixed height in pixels of the HTML window for
+           the report *     summary_window_height - Fixed height in pixels of
+           the summary window for the report *     int debug - Set to 1 to
+           return the time spent in each stage of creating the report *      
+           (validation, zipping, uploads, workspace lookup and save) in
+           ReportInfo *     string idempotency_key - Key identifying this
+           report across retries. When creating *         a report fails part
+           of the way through, a retry with the same key only uploads *      
+           the paths that weren't uploaded yet. Defaults to a key derived
+           from the parameters *     int idempotent - Set to 1 to return the
+           existing report instead of saving a new one *         when the
+           report named report_object_name (which is then required) was saved
+           from *         the same parameters and file contents. Used by
+           create_extended_report and *         create_extended_report_submit)
+           -> structure: parameter
+           "message" of String, parameter "objects_created" of list of type
+           "WorkspaceObject" (* Represents a Workspace object with some brief
+           description text * that can be associated with the object. *
+           Required arguments: *     ws_id ref - workspace ID in the format
+           'workspace_id/object_id/version' * Optional arguments: *    
+           string description - A plaintext, human-readable description of
+           the *         object created) -> structure: parameter "ref" of
+           type "ws_id" (* Workspace ID reference in the format
+           'workspace_id/object_id/version' * @id ws), parameter
+           "description" of String, parameter "warnings" of list of String,
+           parameter "html_links" of list of type "File" (* A file to be
+           linked in the report. Pass in *either* a shock_id or a * path. If
+           a path to a file is given, then the file will be uploaded. If a *
+           path to a directory is given, then it will be zipped and uploaded.
+           * Required arguments: *     string path - Can be a file or
+           directory path. Required if shock_id is absent *     string
+           shock_id - Shock node ID. Required if path is absent *     string
+           name - Plain-text file name -- shown to the user * Optional
+           arguments: *     string description - A plaintext, human-readable
+           description of the file) -> structure: parameter "path" of String,
+           parameter "shock_id" of String, parameter "name" of String,
+           parameter "description" of String, parameter "direct_html" of
+           String, parameter "direct_html_link_index" of Long, parameter
+           "file_links" of list of type "File" (* A file to be linked in the
+           report. Pass in *either* a shock_id or a * path. If a path to a
+           file is given, then the file will be uploaded. If a * path to a
+           directory is given, then it will be zipped and uploaded. *
+           Required arguments: *     string path - Can be a file or directory
+           path. Required if shock_id is absent *     string shock_id - Shock
+           node ID. Required if path is absent *     string name - Plain-text
+           file name -- shown to the user * Optional arguments: *     string
+           description - A plaintext, human-readable description of the file)
+           -> structure: parameter "path" of String, parameter "shock_id" of
+           String, parameter "name" of String, parameter "description" of
+           String, parameter "report_object_name" of String, parameter
+           "html_window_height" of Double, parameter "summary_window_height"
+           of Double, parameter "workspace_name" of String, parameter
+           "workspace_id" of Long, parameter "debug" of Long, parameter
+           "idempotency_key" of String, parameter "idempotent" of Long
+        :returns: instance of list of type "ReportInfo" (* The reference to the saved
+           KBaseReport. This is the return object for * both create() and
+           create_extended() * Returned data: *    ws_id ref - reference to a
+           workspace object in the form of *       
+           'workspace_id/object_id/version'. This is a reference to a saved *
+           Report object (see KBaseReportWorkspace.spec) *    string name -
+           Plaintext unique name for the report. In *        create_extended,
+           this can optionally be set in a parameter *    mapping<string,
+           float> debug - Seconds spent in each stage of creating *       
+           the report. Only returned when the debug parameter is set to 1) ->
+           structure: parameter "ref" of type "ws_id" (* Workspace ID
+           reference in the format 'workspace_id/object_id/version' * @id
+           ws), parameter "name" of String, parameter "debug" of mapping from
+           String to Double
+        """
+        # ctx is the context object
+        # return variables are: infos
+        #BEGIN create_extended_reports
+        timer = StageTimer()
+        with timer.time('validate'):
+            params = validate_extended_reports_params(params, self.fast_validation)
+        scanner = DirScanner(self.scan_threads, timer)
+
+        def preflight():
+            for report_params in params:
+                self._check_size(ctx, 'create_extended_reports', report_params, scanner)
+        infos = report_utils.create_extended_many(params, timer.wrap(self.dfu),
+                                                  self.upload_threads, self.upload_batch_size,
+                                                  self.upload_cache, self.ws_cache, timer,
+                                                  scanner, self.scratch, preflight)
+        for report_params in params:
+            self.metrics.observe('kbase_report_files', len(report_params.get('file_links', [])) +
+                                 len(report_params.get('html_links', [])))
+        breakdown = self._log_timings(ctx, 'create_extended_reports', timer)
+        # The stages are shared by every report, so each report asking for them gets them all
+        for (report_params, info) in zip(params, infos):
+            if report_params.get('debug'):
+                info['debug'] = seconds_by_stage(breakdown)
+        #END create_extended_reports
+
+        # At some point might do deeper type checking...
+        if not isinstance(infos, list):
+            raise ValueError('Method create_extended_reports return value ' +
+                             'infos is not type list as required.')
+        # return the results
+        return [infos]
+
+    def create_extended_report_submit(self, ctx, params):
+        """
+        Start creating an extended report in the background, and return a
+        job ID right away. Takes the same parameters as
+        create_extended_report, which are validated before the job starts.
+        Use check_report_job to follow the progress of the job and to get
+        its ReportInfo.
+        :param params: instance of type "CreateExtendedReportParams" (*
+           Parameters used to create a more complex report with file and HTML
+           links * * Pass in *either* workspace_name or workspace_id -- only
+           one is needed. * Note that workspace_id is preferred over
+           workspace_name because workspace_id immutable. * * Required
+           arguments: *     string workspace_name - Name of the workspace
+           where the report *         should be saved. Required if
+           workspace_id is absent *     int workspace_id - ID of workspace
+           where the report should be saved. *         Required if
+           workspace_name is absent * Optional arguments: *     string
+           message - Simple text message to store in the report object *    
+           list<WorkspaceObject> objects_created - List of result workspace
+           objects that this app *         has created. They will be linked
+           in the report view *     list<string> warnings - A list of
+           plain-text warning messages *     list<File> html_links - A list
+           of paths or shock IDs pointing to HTML files or directories. *    
+           If you pass in paths to directories, they will be zipped and
+           uploaded *     int direct_html_link_index - Index in html_links to
+           set the direct/default view in the *         report. Set either
+           direct_html_link_index or direct_html, but not both *     string
+           direct_html - Simple HTML text content that will be rendered
+           within the report *         widget. Set either direct_html or
+           direct_html_link_index, but not both *     list<File> file_links -
+           A list of file paths or shock node IDs. Allows the user to *      
+           specify files that the report widget should link for download. If
+           you pass in paths *         to directories, they will be zipped * 
+           string report_object_name - Name to use for the report object
+           (will *         be auto-generated if unspecified) *    
+           html_window_height - Fixed height in pixels of the HTML window for
+           the report *     summary_window_height - Fixed height in pixels of
+           the summary window for the report *     int debug - Set to 1 to
+           return the time spent in each stage of creating the report *      
+           (validation, zipping, uploads, workspace lookup and save) in
+           ReportInfo *     string idempotency_key - Key identifying this
+           report across retries. When creating *         a report fails part
+           of the way through, a retry with the same key only uploads *      
+           the paths that weren't uploaded yet. Defaults to a key derived
+           from the parameters *     int idempotent - Set to 1 to return the
+           existing report instead of saving a new one *         when the
+           report named report_object_name (which is then required) was saved
+           from *         the same parameters and file contents. Used by
+           create_extended_report and *         create_extended_report_submit)
+           -> structure: parameter
+           "message" of String, parameter "objects_created" of list of type
+           "WorkspaceObject" (* Represents a Workspace object with some brief
+           description text * that can be associated with the object. *
+           Required arguments: *     ws_id ref - workspace ID in the format
+           'workspace_id/object_id/version' * Optional arguments: *    
+           string description - A plaintext, human-readable description of
+           the *         object created) -> structure: parameter "ref" of
+           type "ws_id" (* Workspace ID reference in the format
+           'workspace_id/object_id/version' * @id ws), parameter
+           "description" of String, parameter "warnings" of list of String,
+           parameter "html_links" of list of type "File" (* A file to be
+           linked in the report. Pass in *either* a shock_id or a * path. If
+           a path to a file is given, then the file will be uploaded. If a *
+           path to a directory is given, then it will be zipped and uploaded.
+           * Required arguments: *     string path - Can be a file or
+           directory path. Required if shock_id is absent *     string
+           shock_id - Shock node ID. Required if path is absent *     string
+           name - Plain-text file name -- shown to the user * Optional
+           arguments: *     string description - A plaintext, human-readable
+           description of the file) -> structure: parameter "path" of String,
+           parameter "shock_id" of String, parameter "name" of String,
+           parameter "description" of String, parameter "direct_html" of
+           String, parameter "direct_html_link_index" of Long, parameter
+           "file_links" of list of type "File" (* A file to be linked in the
+           report. Pass in *either* a shock_id or a * path. If a path to a
+           file is given, then the file will be uploaded. If a * path to a
+           directory is given, then it will be zipped and uploaded. *
+           Required arguments: *     string path - Can be a file or directory
+           path. Required if shock_id is absent *     string shock_id - Shock
+           node ID. Required if path is absent *     string name - Plain-text
+           file name -- shown to the user * Optional arguments: *     string
+           description - A plaintext, human-readable description of the file)
+           -> structure: parameter "path" of String, parameter "shock_id" of
+           String, parameter "name" of String, parameter "description" of
+           String, parameter "report_object_name" of String, parameter
+           "html_window_height" of Double, parameter "summary_window_height"
+           of Double, parameter "workspace_name" of String, parameter
+           "workspace_id" of Long, parameter "debug" of Long, parameter
+           "idempotency_key" of String, parameter "idempotent" of Long
+        :returns: instance of String
+        """
+        # ctx is the context object
+        # return variables are: job_id
+        #BEGIN create_extended_report_submit
+        timer = StageTimer()
+        with timer.time('validate'):
+            params = validate_extended_report_params(params, self.fast_validation)
+        # Report missing paths and reports that are too large now, rather than from
+        # check_report_job
+        scanner = DirScanner(self.scan_threads, timer)
+        self._check_size(ctx, 'create_extended_report_submit', params, scanner)
+        job_id = self.report_jobs.submit(
+            ctx['user_id'],
+            lambda progress: self._create_extended_report(ctx, params, timer, progress, scanner))
+        #END create_extended_report_submit
+
+        # At some point might do deeper type checking...
+        if not isinstance(job_id, basestring):
+            raise ValueError('Method create_extended_report_submit return value ' +
+                             'job_id is not type basestring as required.')
+        # return the results
+        return [job_id]
+
+    def check_report_job(self, ctx, job_id):
+        """
+        Get the status and upload progress of a job started with
+        create_extended_report_submit. Once the job has completed or failed,
+        its status (with its ReportInfo or error) is returned by one call
+        only, and the job is forgotten.
+        :param job_id: instance of String
+        :returns: instance of type "ReportJobStatus" (* The status of a job
+           started with create_extended_report_submit * Returned data: *   
+           string job_id - ID of the job *     string status - One of
+           "queued", "running", "completed" or "error" *     int files_done,
+           files_total - Number of file and HTML links that *         have
+           been uploaded or linked, out of the total *     int bytes_done,
+           bytes_total - Bytes of the file and HTML link paths *        
+           uploaded, out of the total *     ReportInfo result - The created
+           report, when status is "completed" *     string error - Error
+           message, when status is "error") -> structure: parameter "job_id"
+           of String, parameter "status" of String, parameter "files_done" of
+           Long, parameter "files_total" of Long, parameter "bytes_done" of
+           Long, parameter "bytes_total" of Long, parameter "result" of type
+           "ReportInfo" (* The reference to the saved KBaseReport. This is
+           the return object for * both create() and create_extended() *
+           Returned data: *    ws_id ref - reference to a workspace object in
+           the form of *        'workspace_id/object_id/version'. This is a
+           reference to a saved *        Report object (see
+           KBaseReportWorkspace.spec) *    string name - Plaintext unique
+           name for the report. In *        create_extended, this can
+           optionally be set in a parameter *    mapping<string, float> debug
+           - Seconds spent in each stage of creating *        the report. Only
+           returned when the debug parameter is set to 1) -> structure:
+           parameter "ref" of type "ws_id" (* Workspace ID reference in the
+           format 'workspace_id/object_id/version' * @id ws), parameter
+           "name" of String, parameter "debug" of mapping from String to
+           Double, parameter "error" of String
+        """
+        # ctx is the context object
+        # return variables are: status
+        #BEGIN check_report_job
+        status = self.report_jobs.check(ctx['user_id'], job_id)
+        #END check_report_job
+
+        # At some point might do deeper type checking...
+        if not isinstance(status, dict):
+            raise ValueError('Method check_report_job return value ' +
+                             'status is not type dict as required.')
+        # return the results
+        return [status]
     def status(self, ctx):
         #BEGIN_STATUS
         returnVal = {'state': "OK",
@@ -206,5 +686,11 @@ class KBaseReportPy:
                      'version': self.VERSION,
                      'git_url': self.GIT_URL,
                      'git_commit_hash': self.GIT_COMMIT_HASH}
+        returnVal['workspace_id_cache'] = self.ws_cache.stats()
+        returnVal['stage_timings'] = self.timing_histograms.stats()
+        returnVal['report_jobs'] = self.report_jobs.stats()
+        returnVal['report_ref_cache'] = self.report_ref_cache.stats()
+        if self.upload_cache is not None:
+            returnVal['upload_cache'] = self.upload_cache.stats()
         #END_STATUS
         return [returnVal]
@@ -2,10 +2,12 @@
 # -*- coding: utf-8 -*-
 from wsgiref.simple_server import make_server
 import sys
-import json
+import time
 import traceback
 import datetime
+import threading
 from multiprocessing import Process
+from multiprocessing.pool import ThreadPool
 from getopt import getopt, GetoptError
 from jsonrpcbase import JSONRPCService, InvalidParamsError, KeywordError,\
     JSONRPCError, InvalidRequestError
@@ -16,12 +18,19 @@ from biokbase import log
 import requests as _requests
 import random as _random
 import os
+from KBaseReportPy import jsoncodec
 from KBaseReportPy.authclient import KBaseAuth as _KBaseAuth
+from KBaseReportPy.authclient import SqliteTokenCache as _SqliteTokenCache
+from KBaseReportPy.utils.metrics import Metrics
+from KBaseReportPy.utils.metrics import CONTENT_TYPE as _METRICS_CONTENT_TYPE
 
 DEPLOY = 'KB_DEPLOYMENT_CONFIG'
 SERVICE = 'KB_SERVICE_NAME'
 AUTH = 'auth-service-url'
 
+# Size of the chunks a request body is read in
+BODY_CHUNK_SIZE = 1024 * 1024
+
 # Note that the error fields do not match the 2.0 JSONRPC spec
 
 
@@ -49,20 +58,20 @@ from KBaseReportPy.KBaseReportPyImpl import KBaseReportPy  # noqa @IgnorePep8
 impl_KBaseReportPy = KBaseReportPy(config)
 
 
-class JSONObjectEncoder(json.JSONEncoder):
-
-    def default(self, obj):
-        if isinstance(obj, set):
-            return list(obj)
-        if isinstance(obj, frozenset):
-            return list(obj)
-        if hasattr(obj, 'toJSONable'):
-            return obj.toJSONable()
-        return json.JSONEncoder.default(self, obj)
-
-
 class JSONRPCServiceCustom(JSONRPCService):
 
+    def __init__(self, batch_workers=1):
+        """
+        Arguments:
+        batch_workers -- maximum number of calls from a batch request to run
+            at the same time. With 1, they run one after another.
+        """
+        super(JSONRPCServiceCustom, self).__init__()
+        self.batch_workers = batch_workers
+        # Created on the first batch, so it isn't shared by forked workers
+        self._batch_pool = None
+        self._batch_pool_lock = threading.Lock()
+
     def call(self, ctx, jsondata):
         """
         Calls jsonrpc service's method and returns its return value in a JSON
@@ -73,7 +82,7 @@ class JSONRPCServiceCustom(JSONRPCService):
         """
         result = self.call_py(ctx, jsondata)
         if result is not None:
-            return json.dumps(result, cls=JSONObjectEncoder)
+            return jsoncodec.dumps(result)
 
         return None
 
@@ -148,21 +157,20 @@ class JSONRPCServiceCustom(JSONRPCService):
 
             return respond
         elif isinstance(rdata, list) and rdata:
-            # It's a batch.
+            # It's a batch. Each call gets its own response, in the same order,
+            # and an error in one call is returned for that call alone.
             requests = []
-            responds = []
 
             for rdata_ in rdata:
                 # set some default values for error handling
                 request_ = self._get_default_vals()
-                self._fill_request(request_, rdata_)
-                requests.append(request_)
+                requests.append((request_, rdata_))
 
-            for request_ in requests:
-                respond = self._handle_request(ctx, request_)
-                # Don't respond to notifications
-                if respond is not None:
-                    responds.append(respond)
+            responds = [respond for respond in
+                        self._map_batch(lambda (request_, rdata_): self._handle_batch_request(
+                            ctx, request_, rdata_), requests)
+                        # Don't respond to notifications
+                        if respond is not None]
 
             if responds:
                 return responds
@@ -173,6 +181,46 @@ class JSONRPCServiceCustom(JSONRPCService):
             # empty dict, list or wrong type
             raise InvalidRequestError
 
+    def _map_batch(self, func, items):
+        """Calls func on every item of a batch, returning results in order."""
+        if self.batch_workers <= 1 or len(items) <= 1:
+            return [func(item) for item in items]
+        with self._batch_pool_lock:
+            if self._batch_pool is None:
+                self._batch_pool = ThreadPool(self.batch_workers)
+        return self._batch_pool.map(func, items, chunksize=1)
+
+    def _handle_batch_request(self, ctx, request, rdata):
+        """
+        Handles one call of a batch, returning an error response instead of
+        raising an exception, so that the other calls still get their results.
+        """
+        try:
+            self._fill_request(request, rdata)
+            return self._handle_request(ctx, request)
+        except JSONRPCError as jre:
+            code = jre.code
+            name = jre.message
+            message = jre.data
+            trace = jre.trace if hasattr(jre, 'trace') else None
+        except Exception:
+            code = 0
+            name = 'Unexpected Server Error'
+            message = 'An unexpected server error occurred'
+            trace = traceback.format_exc()
+        # Don't respond to notifications, unless they weren't valid requests
+        if request['id'] is None and code != InvalidRequestError.code:
+            return None
+        respond = {'error': {'code': code, 'name': name, 'message': message,
+                             'error': trace}}
+        respond['id'] = request['id']
+        if request['jsonrpc'] == 20:
+            respond['jsonrpc'] = '2.0'
+            respond['error']['data'] = trace
+        else:
+            respond['version'] = '1.1'
+        return respond
+
     def _handle_request(self, ctx, request):
         """Handles given request and returns its response."""
         if self.method_data[request['method']].has_key('types'):  # noqa @IgnorePep8
@@ -246,7 +294,7 @@ class MethodContext(dict):
                         'version': '1.1',
                         'id': str(_random.random())[2:]
                         }
-            body = json.dumps(arg_hash)
+            body = jsoncodec.dumps(arg_hash)
             response = _requests.post(callbackURL, data=body,
                                       timeout=60)
             response.encoding = 'utf-8'
@@ -254,7 +302,7 @@ class MethodContext(dict):
                 if ('content-type' in response.headers and
                         response.headers['content-type'] ==
                         'application/json'):
-                    err = response.json()
+                    err = jsoncodec.loads(response.text)
                     if 'error' in err:
                         raise ServerError(**err['error'])
                     else:
@@ -263,7 +311,7 @@ class MethodContext(dict):
                     raise ServerError('Unknown', 0, response.text)
             if not response.ok:
                 response.raise_for_status()
-            resp = response.json()
+            resp = jsoncodec.loads(response.text)
             if 'result' not in resp:
                 raise ServerError('Unknown', 0,
                                   'An unknown server error occurred')
@@ -294,6 +342,43 @@ class ServerError(Exception):
             '\n' + self.data
 
 
+class RequestTooLargeError(ValueError):
+    '''
+    The request body is larger than the server accepts. As a ValueError, it
+    is reported like any other body that can't be parsed.
+    '''
+
+    def __init__(self, max_size):
+        super(RequestTooLargeError, self).__init__(
+            'Request body is larger than the maximum of %d bytes' % max_size)
+
+
+def read_body(environ, body_size, max_size=0):
+    '''
+    Read a request body, raising RequestTooLargeError as soon as it is known
+    to be larger than max_size bytes (0 for no limit), so oversized bodies are
+    never buffered. A body with a Content-Length is read with a single read
+    once its size is checked. Bodies without one are read to the end in
+    chunks when the server marks the input as terminated.
+    '''
+    if max_size and body_size > max_size:
+        raise RequestTooLargeError(max_size)
+    stream = environ['wsgi.input']
+    if body_size or not environ.get('wsgi.input_terminated'):
+        return stream.read(body_size)
+    chunks = []
+    size = 0
+    while True:
+        chunk = stream.read(BODY_CHUNK_SIZE)
+        if not chunk:
+            break
+        chunks.append(chunk)
+        size += len(chunk)
+        if max_size and size > max_size:
+            raise RequestTooLargeError(max_size)
+    return ''.join(chunks)
+
+
 def getIPAddress(environ):
     xFF = environ.get('HTTP_X_FORWARDED_FOR')
     realIP = environ.get('HTTP_X_REAL_IP')
@@ -331,7 +416,12 @@ class Application(object):
             submod, ip_address=True, authuser=True, module=True, method=True,
             call_id=True, logfile=self.userlog.get_log_file())
         self.serverlog.set_log_level(6)
-        self.rpc_service = JSONRPCServiceCustom()
+        # Larger request bodies are rejected before they are read (0 for no limit)
+        self.max_body_size = int(config.get('max-request-body-bytes', 100 * 1024 * 1024)
+                                 if config else 100 * 1024 * 1024)
+        # Calls in a batch request run on a pool of this many threads
+        batch_workers = int(config.get('rpc-batch-threads', 1)) if config else 1
+        self.rpc_service = JSONRPCServiceCustom(batch_workers)
         self.method_authentication = dict()
         self.rpc_service.add(impl_KBaseReportPy.create,
                              name='KBaseReportPy.create',
@@ -341,16 +431,93 @@ class Application(object):
                              name='KBaseReportPy.create_extended_report',
                              types=[dict])
         self.method_authentication['KBaseReportPy.create_extended_report'] = 'required'  # noqa
+        self.rpc_service.add(impl_KBaseReportPy.create_extended_reports,
+                             name='KBaseReportPy.create_extended_reports',
+                             types=[list])
+        self.method_authentication['KBaseReportPy.create_extended_reports'] = 'required'  # noqa
+        self.rpc_service.add(impl_KBaseReportPy.create_extended_report_submit,
+                             name='KBaseReportPy.create_extended_report_submit',
+                             types=[dict])
+        self.method_authentication['KBaseReportPy.create_extended_report_submit'] = 'required'  # noqa
+        self.rpc_service.add(impl_KBaseReportPy.check_report_job,
+                             name='KBaseReportPy.check_report_job',
+                             types=[basestring])
+        self.method_authentication['KBaseReportPy.check_report_job'] = 'required'  # noqa
         self.rpc_service.add(impl_KBaseReportPy.status,
                              name='KBaseReportPy.status',
                              types=[dict])
         authurl = config.get(AUTH) if config else None
-        self.auth_client = _KBaseAuth(authurl)
+        # A token cache file shared by every server process on the node
+        token_cache_path = config.get('auth-token-cache-path') if config else None
+        token_cache = None
+        if token_cache_path:
+            token_cache = _SqliteTokenCache(token_cache_path)
+        self.auth_client = _KBaseAuth(authurl, token_cache)
+        # Metrics are served for GET requests to this path; set it empty to disable them
+        self.metrics_path = config.get('metrics-path', '/metrics') if config else '/metrics'
+        self.metrics = Metrics()
+        self.metrics.counter('kbase_report_requests_total',
+                             'JSON-RPC requests by method and HTTP status')
+        self.metrics.histogram('kbase_report_request_duration_seconds',
+                               'Seconds taken to handle JSON-RPC requests by method')
+        self.metrics.gauge('kbase_report_requests_in_flight',
+                           'JSON-RPC requests currently being handled')
+        self.metrics.set('kbase_report_requests_in_flight', 0)
+        self.metrics.counter('kbase_report_auth_cache_hits_total',
+                             'Tokens validated from the auth cache')
+        self.metrics.counter('kbase_report_auth_cache_misses_total',
+                             'Tokens validated by the auth service')
+        self.metrics.counter('kbase_report_auth_cache_evictions_total',
+                             'Tokens dropped from the full auth cache or expired')
+        self.metrics.counter('kbase_report_auth_coalesced_total',
+                             'Token lookups that waited on the same token being validated')
+        self.metrics.gauge('kbase_report_auth_cache_hit_ratio',
+                           'Fraction of token validations answered from the auth cache')
 
     def __call__(self, environ, start_response):
+        if (self.metrics_path and environ['REQUEST_METHOD'] == 'GET' and
+                environ.get('PATH_INFO') == self.metrics_path):
+            return self.serve_metrics(start_response)
         # Context object, equivalent to the perl impl CallContext
         ctx = MethodContext(self.userlog)
         ctx['client_ip'] = getIPAddress(environ)
+        statuses = []
+
+        def record_status(status, headers):
+            statuses.append(status)
+            return start_response(status, headers)
+        start = time.time()
+        self.metrics.inc('kbase_report_requests_in_flight')
+        try:
+            return self.handle_rpc(environ, record_status, ctx)
+        finally:
+            self.metrics.dec('kbase_report_requests_in_flight')
+            # Only label registered methods, so unknown names can't add unbounded labels
+            method = 'unknown'
+            if ctx['method'] is not None:
+                name = ctx['module'] + '.' + ctx['method']
+                if name in self.rpc_service.method_data:
+                    method = name
+            status = statuses[0].split(' ')[0] if statuses else '500'
+            self.metrics.inc('kbase_report_requests_total', method=method, status=status)
+            self.metrics.observe('kbase_report_request_duration_seconds',
+                                 time.time() - start, method=method)
+
+    def serve_metrics(self, start_response):
+        auth_stats = self.auth_client.cache_stats()
+        lookups = auth_stats['hits'] + auth_stats['misses']
+        self.metrics.set('kbase_report_auth_cache_hits_total', auth_stats['hits'])
+        self.metrics.set('kbase_report_auth_cache_misses_total', auth_stats['misses'])
+        self.metrics.set('kbase_report_auth_cache_evictions_total', auth_stats['evictions'])
+        self.metrics.set('kbase_report_auth_coalesced_total', auth_stats['coalesced'])
+        self.metrics.set('kbase_report_auth_cache_hit_ratio',
+                         auth_stats['hits'] / float(lookups) if lookups else 0.0)
+        response_body = self.metrics.render() + impl_KBaseReportPy.metrics.render()
+        start_response('200 OK', [('content-type', _METRICS_CONTENT_TYPE),
+                                  ('content-length', str(len(response_body)))])
+        return [response_body]
+
+    def handle_rpc(self, environ, start_response, ctx):
         status = '500 Internal Server Error'
 
         try:
@@ -362,9 +529,10 @@ class Application(object):
             status = '200 OK'
             rpc_result = ""
         else:
-            request_body = environ['wsgi.input'].read(body_size)
             try:
-                req = json.loads(request_body)
+                request_body = read_body(environ, body_size,
+                                         self.max_body_size)
+                req = jsoncodec.loads(request_body)
             except ValueError as ve:
                 err = {'error': {'code': -32700,
                                  'name': "Parse error",
@@ -373,25 +541,32 @@ class Application(object):
                        }
                 rpc_result = self.process_error(err, ctx, {'version': '1.1'})
             else:
-                ctx['module'], ctx['method'] = req['method'].split('.')
-                ctx['call_id'] = req['id']
+                # Calls in a batch share the context of the first call
+                calls = req if isinstance(req, list) else [req]
+                first_call = calls[0]
+                ctx['module'], ctx['method'] = first_call['method'].split('.')
+                ctx['call_id'] = first_call['id']
                 ctx['rpc_context'] = {
                     'call_stack': [{'time': self.now_in_utc(),
-                                    'method': req['method']}
+                                    'method': first_call['method']}
                                    ]
                 }
                 prov_action = {'service': ctx['module'],
                                'method': ctx['method'],
-                               'method_params': req['params']
+                               'method_params': first_call['params']
                                }
                 ctx['provenance'] = [prov_action]
                 try:
                     token = environ.get('HTTP_AUTHORIZATION')
-                    # parse out the method being requested and check if it
-                    # has an authentication requirement
-                    method_name = req['method']
-                    auth_req = self.method_authentication.get(
-                        method_name, 'none')
+                    # parse out the methods being requested and check if
+                    # they have an authentication requirement
+                    auth_reqs = [self.method_authentication.get(
+                        call.get('method'), 'none')
+                        for call in calls if isinstance(call, dict)]
+                    auth_req = 'none'
+                    for level in ['optional', 'required']:
+                        if level in auth_reqs:
+                            auth_req = level
                     if auth_req != 'none':
                         if token is None and auth_req == 'required':
                             err = JSONServerError()
@@ -475,7 +650,7 @@ class Application(object):
         else:
             error['version'] = '1.0'
             error['error']['error'] = trace
-        return json.dumps(error)
+        return jsoncodec.dumps(error)
 
     def now_in_utc(self):
         # noqa Taken from http://stackoverflow.com/questions/3401428/how-to-get-an-isoformat-datetime-string-including-the-default-timezone @IgnorePep8
@@ -552,7 +727,7 @@ def stop_server():
 def process_async_cli(input_file_path, output_file_path, token):
     exit_code = 0
     with open(input_file_path) as data_file:
-        req = json.load(data_file)
+        req = jsoncodec.loads(data_file.read())
     if 'version' not in req:
         req['version'] = '1.1'
     if 'id' not in req:
@@ -594,7 +769,7 @@ def process_async_cli(input_file_path, output_file_path, token):
     if 'error' in resp:
         exit_code = 500
     with open(output_file_path, "w") as f:
-        f.write(json.dumps(resp, cls=JSONObjectEncoder))
+        f.write(jsoncodec.dumps(resp))
     return exit_code
 
 if __name__ == "__main__":
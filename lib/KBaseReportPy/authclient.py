@@ -5,35 +5,118 @@ A very basic KBase auth client for the Python server.
 
 @author: gaprice@lbl.gov
 '''
+import os as _os
+import sqlite3 as _sqlite3
 import time as _time
 import requests as _requests
 import threading as _threading
 import hashlib
+import sys
+from collections import OrderedDict
 
 
 class TokenCache(object):
-    ''' A basic cache for tokens. '''
+    '''
+    A least recently used cache for tokens, whose entries each expire after
+    _MAX_TIME_SEC. Every operation is O(1).
+    '''
 
     _MAX_TIME_SEC = 5 * 60  # 5 min
 
-    _lock = _threading.RLock()
-
     def __init__(self, maxsize=2000):
-        self._cache = {}
+        # Each cache has its own lock, which is only held for O(1) operations
+        self._lock = _threading.Lock()
+        # Ordered from least to most recently used: hashed token -> [user, expiry time]
+        self._cache = OrderedDict()
         self._maxsize = maxsize
-        self._halfmax = maxsize / 2  # int division to round down
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
 
-    def get_user(self, token):
+    def get_user(self, token, count=True):
+        '''
+        Get the user for a cached token, or None
+        count - whether to count the lookup as a hit or miss in stats()
+        '''
         token = hashlib.sha256(token).hexdigest()
+        now = _time.time()
         with self._lock:
-            usertime = self._cache.get(token)
-        if not usertime:
-            return None
+            usertime = self._cache.pop(token, None)
+            if not usertime:
+                self.misses += count
+                return None
+            if now > usertime[1]:
+                # Expired, so it stays removed
+                self.misses += count
+                self.evictions += 1
+                return None
+            # Re-inserting marks it as the most recently used
+            self._cache[token] = usertime
+            self.hits += count
+        return usertime[0]
 
-        user, intime = usertime
-        if _time.time() - intime > self._MAX_TIME_SEC:
-            return None
-        return user
+    def add_valid_token(self, token, user):
+        if not token:
+            raise ValueError('Must supply token')
+        if not user:
+            raise ValueError('Must supply user')
+        token = hashlib.sha256(token).hexdigest()
+        expires = _time.time() + self._MAX_TIME_SEC
+        with self._lock:
+            self._cache.pop(token, None)
+            self._cache[token] = [user, expires]
+            while len(self._cache) > self._maxsize:
+                self._cache.popitem(last=False)
+                self.evictions += 1
+
+    def stats(self):
+        with self._lock:
+            return {'hits': self.hits, 'misses': self.misses,
+                    'evictions': self.evictions, 'size': len(self._cache)}
+
+
+class SqliteTokenCache(object):
+    '''
+    A token cache in a sqlite file that every server process on a node can
+    share, so that a token is validated once per node rather than once per
+    worker. Like TokenCache, tokens are stored by their sha256 hash and
+    expire after _MAX_TIME_SEC.
+    '''
+
+    _MAX_TIME_SEC = TokenCache._MAX_TIME_SEC
+
+    def __init__(self, path, maxsize=20000):
+        self._path = path
+        self._maxsize = maxsize
+        # sqlite connections can't be shared between threads or processes
+        self._local = _threading.local()
+        self._lock = _threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._connect()
+
+    def get_user(self, token, count=True):
+        '''
+        Get the user for a cached token, or None
+        count - whether to count the lookup as a hit or miss in stats()
+        '''
+        token = hashlib.sha256(token).hexdigest()
+        now = _time.time()
+        conn = self._connect()
+        row = conn.execute('SELECT user, expires FROM tokens WHERE token = ?',
+                           (token,)).fetchone()
+        if row and now > row[1]:
+            with conn:
+                conn.execute('DELETE FROM tokens WHERE token = ? AND expires < ?',
+                             (token, now))
+        with self._lock:
+            if not row or now > row[1]:
+                self.misses += count
+                self.evictions += 1 if row else 0
+                return None
+            self.hits += count
+        return row[0]
 
     def add_valid_token(self, token, user):
         if not token:
@@ -41,15 +124,46 @@ class TokenCache(object):
         if not user:
             raise ValueError('Must supply user')
         token = hashlib.sha256(token).hexdigest()
+        now = _time.time()
+        conn = self._connect()
+        with conn:
+            conn.execute('INSERT OR REPLACE INTO tokens VALUES (?, ?, ?)',
+                         (token, user, now + self._MAX_TIME_SEC))
+            evicted = conn.execute('DELETE FROM tokens WHERE expires < ?',
+                                   (now,)).rowcount
+            # Past maxsize, drop the tokens that expire soonest
+            evicted += conn.execute(
+                'DELETE FROM tokens WHERE token IN (SELECT token FROM tokens '
+                'ORDER BY expires LIMIT max(0, (SELECT count(*) FROM tokens) - ?))',
+                (self._maxsize,)).rowcount
+        with self._lock:
+            self.evictions += evicted
+
+    def stats(self):
+        size = self._connect().execute('SELECT count(*) FROM tokens').fetchone()[0]
         with self._lock:
-            self._cache[token] = [user, _time.time()]
-            if len(self._cache) > self._maxsize:
-                for i, (t, _) in enumerate(sorted(self._cache.items(),
-                                                  key=lambda (_, v): v[1])):
-                    if i <= self._halfmax:
-                        del self._cache[t]
-                    else:
-                        break
+            return {'hits': self.hits, 'misses': self.misses,
+                    'evictions': self.evictions, 'size': size}
+
+    def _connect(self):
+        ''' Get this thread's connection, making one after a fork too '''
+        (pid, conn) = getattr(self._local, 'connection', (None, None))
+        if pid == _os.getpid():
+            return conn
+        created = not _os.path.exists(self._path)
+        conn = _sqlite3.connect(self._path, timeout=30)
+        if created:
+            # Tokens are credentials, so only this user can read their hashes
+            _os.chmod(self._path, 0o600)
+        # Write-ahead logging lets workers read while another one writes
+        conn.execute('PRAGMA journal_mode=WAL')
+        with conn:
+            conn.execute('CREATE TABLE IF NOT EXISTS tokens '
+                         '(token TEXT PRIMARY KEY, user TEXT, expires REAL)')
+            conn.execute('CREATE INDEX IF NOT EXISTS tokens_expires '
+                         'ON tokens (expires)')
+        self._local.connection = (_os.getpid(), conn)
+        return conn
 
 
 class KBaseAuth(object):
@@ -59,14 +173,32 @@ class KBaseAuth(object):
 
     _LOGIN_URL = 'https://kbase.us/services/auth/api/legacy/KBase/Sessions/Login'
 
-    def __init__(self, auth_url=None):
+    def __init__(self, auth_url=None, cache=None):
         '''
         Constructor
+        cache - the token cache to use, such as a SqliteTokenCache shared by
+            every server process. Defaults to a TokenCache for this process.
         '''
         self._authurl = auth_url
         if not self._authurl:
             self._authurl = self._LOGIN_URL
-        self._cache = TokenCache()
+        self._cache = cache if cache is not None else TokenCache()
+        # Validations in progress, by hashed token (see get_user)
+        self._in_flight = {}
+        self._in_flight_lock = _threading.Lock()
+        self.coalesced = 0
+
+    def cache_stats(self):
+        '''
+        The number of token lookups answered from the cache (hits) or by the
+        auth service (misses), the number of tokens dropped from the cache
+        because it was full or they expired (evictions), the number of
+        cached tokens (size), and the number of lookups that waited on
+        another request's validation of the same token (coalesced).
+        '''
+        stats = self._cache.stats()
+        stats['coalesced'] = self.coalesced
+        return stats
 
     def get_user(self, token):
         if not token:
@@ -75,6 +207,39 @@ class KBaseAuth(object):
         if user:
             return user
 
+        # Only one request validates a token with the auth service at a time.
+        # Concurrent requests with the same token wait for and share its
+        # result or error.
+        key = hashlib.sha256(token).hexdigest()
+        with self._in_flight_lock:
+            flight = self._in_flight.get(key)
+            if flight is None:
+                # A validation may have finished since the cache was checked.
+                # Leaders cache the user before they leave _in_flight, so
+                # checking again here makes sure only one of them runs.
+                user = self._cache.get_user(token, count=False)
+                if user:
+                    self.coalesced += 1
+                    return user
+            leader = flight is None
+            if leader:
+                flight = self._in_flight[key] = _Validation()
+            else:
+                self.coalesced += 1
+        if not leader:
+            return flight.wait()
+        try:
+            flight.user = self._validate(token)
+        except Exception:
+            flight.exc_info = sys.exc_info()
+            raise
+        finally:
+            with self._in_flight_lock:
+                del self._in_flight[key]
+            flight.done.set()
+        return flight.user
+
+    def _validate(self, token):
         d = {'token': token, 'fields': 'user_id'}
         ret = _requests.post(self._authurl, data=d)
         if not ret.ok:
@@ -89,3 +254,18 @@ class KBaseAuth(object):
         user = ret.json()['user_id']
         self._cache.add_valid_token(token, user)
         return user
+
+
+class _Validation(object):
+    ''' The result of a token validation that other requests can wait on. '''
+
+    def __init__(self):
+        self.done = _threading.Event()
+        self.user = None
+        self.exc_info = None
+
+    def wait(self):
+        self.done.wait()
+        if self.exc_info:
+            raise self.exc_info[0], self.exc_info[1], self.exc_info[2]
+        return self.user
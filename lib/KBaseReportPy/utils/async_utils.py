@@ -0,0 +1,85 @@
+# -*- coding: utf-8 -*-
+import sys
+import threading as _threading
+import time as _time
+
+"""
+Utilities for running blocking calls in the background
+`run_steps` runs a small dependency graph of calls, such as DataFileUtil methods, so that
+independent steps overlap
+"""
+
+
+class Cancelled(Exception):
+    ''' Raised by a step that stopped early because another step failed. '''
+
+
+def run_steps(steps, timer=None, cancel=None):
+    """
+    Run a dependency graph of steps, starting each one as soon as its dependencies are done
+    If any step raises an exception, no more steps are started and the exception is re-raised
+    right away. Steps that are still running are not waited for, so long steps should check
+    `cancel` and stop early, such as by raising Cancelled.
+    :param steps: list of (name, dependency names, function). A step's dependencies must be
+        listed before it, and its function is called with their results, in order.
+    :param timer: optional StageTimer (see ./timing_utils.py) that records how long each step took
+    :param cancel: optional threading.Event that is set as soon as any step fails
+    :return: dict of the result of every step, by name
+    """
+    names = set()
+    for (name, deps, _) in steps:
+        missing = [dep for dep in deps if dep not in names]
+        if missing:
+            raise ValueError('Step ' + name + ' depends on unknown steps: ' + ', '.join(missing))
+        names.add(name)
+    cond = _threading.Condition()
+    pending = list(steps)
+    running = set()
+    results = {}
+    errors = []
+
+    def run_step(name, func, args):
+        start = _time.time()
+        (result, exc_info) = (None, None)
+        try:
+            result = func(*args)
+        except BaseException:
+            # Anything raised, including SystemExit, is re-raised by the waiting thread
+            exc_info = sys.exc_info()
+        finally:
+            if timer is not None:
+                timer.add(name, _time.time() - start)
+            with cond:
+                running.remove(name)
+                if exc_info:
+                    errors.append(exc_info)
+                    if cancel is not None:
+                        cancel.set()
+                else:
+                    results[name] = result
+                    start_ready()
+                cond.notify()
+
+    def start_ready():
+        """ Start every pending step whose dependencies are done; call with `cond` held """
+        if errors:
+            return
+        for step in list(pending):
+            (name, deps, func) = step
+            if all(dep in results for dep in deps):
+                pending.remove(step)
+                running.add(name)
+                args = (name, func, [results[dep] for dep in deps])
+                thread = _threading.Thread(target=run_step, args=args)
+                # Steps still running after another one failed don't keep the process alive
+                thread.daemon = True
+                thread.start()
+
+    with cond:
+        start_ready()
+        while (pending or running) and not errors:
+            cond.wait()
+        if errors:
+            raise errors[0][0], errors[0][1], errors[0][2]
+    return results
+
@@ -0,0 +1,202 @@
+# -*- coding: utf-8 -*-
+import hashlib
+import os
+import stat
+import threading as _threading
+import time as _time
+from multiprocessing.pool import ThreadPool
+
+try:
+    from os import scandir as _scandir  # py3
+except ImportError:
+    try:
+        from scandir import scandir as _scandir  # py2 backport, if installed
+    except ImportError:
+        _scandir = None
+
+"""
+Utilities for walking, stat-ing and hashing the paths of file and HTML links
+Large HTML directories can hold tens of thousands of small files, so directories are listed and
+files are hashed on a pool of threads. The result is a Manifest, which the packer, the upload
+cache and journal, and upload progress all read instead of walking the tree again.
+"""
+
+# Size of the blocks used when reading files to compute their digest
+_DIGEST_CHUNK_SIZE = 1024 * 1024
+
+
+class Manifest(object):
+    ''' The files at a path, with their sizes, modification times, and optionally digests. '''
+
+    def __init__(self, path, isdir, files, mtime):
+        self.path = path
+        self.isdir = isdir
+        # (path relative to `path`, size, mtime, SHA-256 hex digest or None) for each file, in
+        # the order of a walk that visits sorted files before sorted sub-directories
+        # For a single file, there is one entry, whose relative path is the file's basename
+        self.files = files
+        # Latest modification time of the path, or of any file or directory inside it
+        self.mtime = mtime
+        self.size = sum(size for (_, size, _, _) in files)
+
+    def has_digests(self):
+        """ Whether the digest of every file has been computed """
+        return all(digest is not None for (_, _, _, digest) in self.files)
+
+    def abspaths(self):
+        """ Generate the (absolute path, relative path) of every file """
+        if not self.isdir:
+            yield (self.path, self.files[0][0])
+            return
+        for (relpath, _, _, _) in self.files:
+            yield (os.path.join(self.path, relpath), relpath)
+
+
+class DirScanner(object):
+    '''
+    Scans paths into Manifests, keeping each one so that a path is only walked and hashed once.
+    Use a new scanner for each report, so that files changed in between are scanned again.
+    '''
+
+    def __init__(self, max_workers=8, timer=None):
+        """
+        :param max_workers: number of threads that list directories and hash files
+        :param timer: optional StageTimer (see ./timing_utils.py) for the time spent scanning
+            and hashing
+        """
+        self._max_workers = max_workers
+        self._timer = timer
+        self._lock = _threading.Lock()
+        # Absolute path -> Manifest
+        self._manifests = {}
+
+    def scan(self, path, digests=False):
+        """
+        Get the manifest of a file or directory
+        :param path: file or directory to scan
+        :param digests: whether the manifest needs the digest of every file
+        :return: Manifest
+        """
+        path = os.path.abspath(path)
+        with self._lock:
+            manifest = self._manifests.get(path)
+        if manifest is None:
+            start = _time.time()
+            manifest = scan(path, max_workers=self._max_workers)
+            self._add_time('scan', start)
+        if digests and not manifest.has_digests():
+            start = _time.time()
+            manifest = add_digests(manifest, self._max_workers)
+            self._add_time('hash', start)
+        with self._lock:
+            self._manifests[path] = manifest
+        return manifest
+
+    def _add_time(self, stage, start):
+        if self._timer is not None:
+            self._timer.add(stage, _time.time() - start)
+
+
+def scan(path, digests=False, max_workers=8):
+    """
+    Walk and stat a file or directory, listing sub-directories on a pool of threads
+    Like os.walk, symbolic links to directories are not followed, while symbolic links to files
+    are listed with the size and mtime of the file they point to.
+    :param path: file or directory to scan
+    :param digests: whether to also compute the digest of every file (see add_digests)
+    :param max_workers: number of threads to use
+    :return: Manifest
+    """
+    st = os.stat(path)
+    if not stat.S_ISDIR(st.st_mode):
+        manifest = Manifest(path, False, [(os.path.basename(path), st.st_size, st.st_mtime, None)],
+                            st.st_mtime)
+    else:
+        manifest = _scan_dir(path, st.st_mtime, max_workers)
+    if digests:
+        manifest = add_digests(manifest, max_workers)
+    return manifest
+
+
+def add_digests(manifest, max_workers=8):
+    """
+    Compute the SHA-256 digest of every file in a manifest, on a pool of threads
+    :return: new Manifest with the digests
+    """
+    paths = [abspath for (abspath, _) in manifest.abspaths()]
+    digests = _map(file_digest, paths, max_workers)
+    files = [(relpath, size, mtime, digest)
+             for ((relpath, size, mtime, _), digest) in zip(manifest.files, digests)]
+    return Manifest(manifest.path, manifest.isdir, files, manifest.mtime)
+
+
+def file_digest(path):
+    """ Compute the SHA-256 hex digest of a file's content, reading it in chunks """
+    digest = hashlib.sha256()
+    with open(path, 'rb') as fd:
+        for chunk in iter(lambda: fd.read(_DIGEST_CHUNK_SIZE), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def _scan_dir(root, root_mtime, max_workers):
+    """ Scan a directory one level at a time, listing every directory of a level in parallel """
+    # Relative directory path -> (sorted (name, size, mtime) of files, sorted sub-directory names)
+    listings = {}
+    mtime = root_mtime
+    level = ['']
+    while level:
+        for (reldir, (files, subdirs)) in zip(level, _map(lambda reldir: _list_dir(root, reldir),
+                                                         level, max_workers)):
+            listings[reldir] = (files, [name for (name, _) in subdirs])
+            mtime = max([mtime] + [m for (_, _, m) in files] + [m for (_, m) in subdirs])
+        level = [os.path.join(reldir, name) for reldir in level for name in listings[reldir][1]]
+    # Put the files in the same order as a sorted os.walk, depth first
+    files = []
+    stack = ['']
+    while stack:
+        reldir = stack.pop()
+        (dir_files, subdirs) = listings[reldir]
+        files += [(os.path.join(reldir, name), size, file_mtime, None)
+                  for (name, size, file_mtime) in dir_files]
+        stack += [os.path.join(reldir, name) for name in reversed(subdirs)]
+    return Manifest(root, True, files, mtime)
+
+
+def _list_dir(root, reldir):
+    """
+    List one directory
+    :return: tuple of (sorted (name, size, mtime) of files, sorted (name, mtime) of directories)
+    """
+    dirpath = os.path.join(root, reldir)
+    (files, subdirs) = ([], [])
+    if _scandir is not None:
+        for entry in _scandir(dirpath):
+            if entry.is_dir():
+                # Symbolic links to directories are skipped, as they are by os.walk
+                if not entry.is_symlink():
+                    subdirs.append((entry.name, entry.stat().st_mtime))
+            else:
+                st = entry.stat()
+                files.append((entry.name, st.st_size, st.st_mtime))
+    else:
+        for name in os.listdir(dirpath):
+            path = os.path.join(dirpath, name)
+            st = os.stat(path)
+            if stat.S_ISDIR(st.st_mode):
+                if not os.path.islink(path):
+                    subdirs.append((name, st.st_mtime))
+            else:
+                files.append((name, st.st_size, st.st_mtime))
+    return (sorted(files), sorted(subdirs))
+
+
+def _map(func, items, max_workers):
+    """ Call `func` on every item, on a pool of at most `max_workers` threads """
+    if max_workers <= 1 or len(items) <= 1:
+        return [func(item) for item in items]
+    pool = ThreadPool(min(max_workers, len(items)))
+    try:
+        return pool.map(func, items, chunksize=max(1, len(items) // (max_workers * 4)))
+    finally:
+        pool.terminate()
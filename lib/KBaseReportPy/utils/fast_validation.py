@@ -0,0 +1,100 @@
+# -*- coding: utf-8 -*-
+from collections import Mapping, Sequence
+
+"""
+A fast, single-pass alternative to cerberus for the parameter schemas in ./validation_utils.py
+A schema is compiled once into nested check functions, so validating a document only costs one
+type check per value instead of cerberus' generic rule dispatch and child validators.
+Only the cerberus rules used by our schemas are supported, and errors use cerberus' wording,
+keyed by the dotted path to the invalid value (eg. "file_links.0.name").
+cerberus remains the reference implementation; see the tests comparing the two.
+"""
+
+_TYPE_CHECKS = {
+    'string': lambda value: isinstance(value, basestring),
+    'integer': lambda value: isinstance(value, (int, long)),
+    'dict': lambda value: isinstance(value, Mapping),
+    'list': lambda value: isinstance(value, Sequence) and not isinstance(value, basestring)
+}
+
+_SUPPORTED_RULES = frozenset(['type', 'required', 'minlength', 'min', 'schema'])
+
+
+def compile_schema(schema):
+    """
+    Compile a cerberus schema for a dict into a validation function
+    :param schema: cerberus schema, mapping field names to their rules
+    :return: function that takes a document and returns a dict of errors (empty if valid)
+    """
+    check_document = _compile_dict(schema)
+
+    def validate(document):
+        errors = {}
+        check_document(document, '', errors)
+        return errors
+    return validate
+
+
+def _compile_dict(schema):
+    """ Compile the schema of a dict into a function of (document, key, errors) """
+    fields = dict((name, _compile_field(rules)) for (name, rules) in schema.items())
+    required = [name for (name, rules) in schema.items() if rules.get('required')]
+
+    def check_dict(document, key, errors):
+        prefix = key + '.' if key else ''
+        for (name, value) in document.iteritems():
+            check_field = fields.get(name)
+            if check_field is None:
+                _add_error(errors, prefix + name, 'unknown field')
+            else:
+                check_field(value, prefix + name, errors)
+        for name in required:
+            if name not in document:
+                _add_error(errors, prefix + name, 'required field')
+    return check_dict
+
+
+def _compile_field(rules):
+    """ Compile the rules for a single value into a function of (value, key, errors) """
+    unsupported = set(rules) - _SUPPORTED_RULES
+    if unsupported:
+        raise ValueError('Rules not supported by fast validation: ' + ', '.join(unsupported))
+    type_name = rules['type']
+    is_type = _TYPE_CHECKS[type_name]
+    minlength = rules.get('minlength')
+    minimum = rules.get('min')
+    check_children = None
+    if 'schema' in rules and type_name == 'dict':
+        check_children = _compile_dict(rules['schema'])
+    elif 'schema' in rules:
+        check_children = _compile_items(rules['schema'])
+
+    def check_field(value, key, errors):
+        if value is None:
+            _add_error(errors, key, 'null value not allowed')
+            return
+        if not is_type(value):
+            # Like cerberus, skip the remaining rules for a value of the wrong type
+            _add_error(errors, key, 'must be of ' + type_name + ' type')
+            return
+        if minlength is not None and len(value) < minlength:
+            _add_error(errors, key, 'min length is ' + str(minlength))
+        if minimum is not None and value < minimum:
+            _add_error(errors, key, 'min value is ' + str(minimum))
+        if check_children:
+            check_children(value, key, errors)
+    return check_field
+
+
+def _compile_items(rules):
+    """ Compile the rules for every item of a list into a function of (items, key, errors) """
+    check_item = _compile_field(rules)
+
+    def check_items(items, key, errors):
+        for (idx, item) in enumerate(items):
+            check_item(item, key + '.' + str(idx), errors)
+    return check_items
+
+
+def _add_error(errors, key, message):
+    errors.setdefault(key, []).append(message)
@@ -1,8 +1,16 @@
 # -*- coding: utf-8 -*-
+import hashlib
 import os
 import shutil
+import sys
+import time as _time
+from multiprocessing.pool import ThreadPool
 from uuid import uuid4
 
+from DataFileUtil.baseclient import ServerError as _DFUError
+from async_utils import Cancelled
+from dir_scan import DirScanner
+from pack_utils import zip_directory, zip_file
 from validation_utils import validate_files
 
 """
@@ -11,64 +19,365 @@ We use an instance of DataFileUtil here
 """
 
 
-def fetch_or_upload_file_links(dfu, files):
+class UploadError(Exception):
+    ''' A DataFileUtil call failed for some links. The original exception is kept as `cause`. '''
+
+    def __init__(self, message, cause):
+        super(UploadError, self).__init__(message)
+        self.cause = cause
+
+
+def fetch_or_upload_links(dfu, file_links, html_links, max_workers=1, batch_size=0,
+                          cache=None, timer=None, progress=None, journal=None, scanner=None,
+                          scratch=None, cancel=None):
     """
-    Given a list of dictionaries of files for the `file_links` parameter in an extended_report
-    Fetch by shock ID or upload the file or zipped directory
+    Fetch or upload both the `file_links` and `html_links` of an extended report
+    All uploads and ownership calls share a single pool of `max_workers` threads
     :param dfu: DataFileUtil client instance
-    :param files: list of file dictionaries (having the File type from the KIDL spec)
-    :return: list of file dictionaries that that can be uploaded to the workspace for the report
+    :param file_links: list of file dictionaries for `file_links`
+    :param html_links: list of file dictionaries for `html_links`
+    :param max_workers: maximum number of uploads to run at the same time
+    :param batch_size: if greater than zero, upload paths with file_to_shock_mass in groups
+        of at most this many files instead of with one file_to_shock call per file. Groups are
+        made smaller when needed so that every one of the `max_workers` threads gets one.
+    :param cache: optional UploadCache (see ./upload_cache.py). Paths whose content digest is
+        in the cache are linked with own_shock_node instead of being uploaded again
+    :param timer: optional StageTimer (see ./timing_utils.py) for the time spent zipping,
+        and the number of bytes uploaded
+    :param progress: optional JobProgress (see ./report_jobs.py) that is given the total number
+        of links and bytes of their paths, and is updated as each upload or ownership call is done
+    :param journal: optional UploadJournal (see ./upload_journal.py). Paths recorded in it that
+        have not changed since are not uploaded again, and every new upload is recorded in it
+    :param scanner: optional DirScanner (see ./dir_scan.py) holding the manifests of paths that
+        were already scanned for this report
+    :param scratch: directory to write zip files to before uploading them. It must be readable
+        by DataFileUtil. Defaults to the directory holding each zipped path.
+    :param cancel: optional threading.Event. Once it is set, no more uploads are started and
+        Cancelled is raised (see ./async_utils.py)
+    :return: tuple of (file_links, html_links) in the same order as they were given
     """
-    out_files = []
-    validate_files(files)  # Assures that every file has either a 'path' or 'shock_id'
-    for each_file in files:
-        if 'path' in each_file:
-            # Only zip if the path is a directory
-            isdir = os.path.isdir(each_file['path'])
-            shock = dfu.file_to_shock({
-                'file_path': each_file['path'],
-                'make_handle': 1,
-                'pack': 'zip' if isdir else None
-            })
-        elif 'shock_id' in each_file:
+    validate_files(file_links)  # Assures that every file has either a 'path' or 'shock_id'
+    validate_files(html_links)
+    if scanner is None:
+        scanner = DirScanner(timer=timer)
+    links = [(f, _file_to_shock_params) for f in file_links]
+    links += [(f, _html_to_shock_params) for f in html_links]
+    # Each job fetches or uploads the links at a list of indexes, returning their shock info
+    jobs = []
+    to_upload = []
+    for (idx, (each_file, _)) in enumerate(links):
+        if 'path' not in each_file:
             # Having a 'shock_id' means it is already uploaded
-            shock = dfu.own_shock_node({'shock_id': each_file['shock_id'], 'make_handle': 1})
-        out_files.append(_create_file_link(each_file, shock))
-    return out_files
+            jobs.append(([idx], _own_shock_node))
+        elif batch_size > 0:
+            to_upload.append(idx)
+        else:
+            jobs.append(([idx], _file_to_shock))
+    if to_upload:
+        # Batching must not serialize the uploads, so the paths are spread over every worker
+        batch_size = min(batch_size, -(-len(to_upload) // max(max_workers, 1)))
+        for start in range(0, len(to_upload), batch_size):
+            jobs.append((to_upload[start:start + batch_size], _file_to_shock_mass))
+    sizes = None
+    if progress is not None:
+        # Links to existing shock nodes count as files, but have no bytes to upload
+        sizes = [scanner.scan(f['path']).size if 'path' in f else 0 for (f, _) in links]
+        progress.start(len(links), sum(sizes))
 
+    def run_job((idxs, run)):
+        if cancel is not None and cancel.is_set():
+            raise Cancelled('Uploads cancelled')
+        result = run(dfu, [links[i] for i in idxs], cache, timer, journal, scanner, scratch)
+        if progress is not None:
+            progress.add(len(idxs), sum(sizes[i] for i in idxs))
+        return result
+    try:
+        results = _run_concurrently(run_job, jobs, max_workers)
+    finally:
+        if cache is not None:
+            cache.save()
+    shocks = [None] * len(links)
+    for ((idxs, _), result) in zip(jobs, results):
+        for (idx, shock) in zip(idxs, result):
+            shocks[idx] = shock
+    out_files = [_create_file_link(f, shock) for ((f, _), shock) in zip(links, shocks)]
+    return (out_files[:len(file_links)], out_files[len(file_links):])
 
-def fetch_or_upload_html_links(dfu, files):
+
+def content_digest(file_links, html_links, scanner=None):
     """
-    Given a list of dictionaries of files that each have either 'path' or 'shock_id'
-    Fetch by shock ID or upload a zipped directory
-    :param dfu: DataFileUtil client instance
-    :param files: list of file dictionaries (having the File type from the KIDL spec)
-    :return: list of file dictionaries that that can be uploaded to the workspace for the report
+    Compute a SHA-256 digest of everything that would be uploaded for the paths of some links
+    Each path is covered the same way as for the upload cache (see _path_digest), and links to
+    existing shock nodes only by their position
+    :param file_links: list of file dictionaries for `file_links`
+    :param html_links: list of file dictionaries for `html_links`
+    :param scanner: optional DirScanner (see ./dir_scan.py) to scan and hash the paths with
+    :return: hex digest
+    """
+    validate_files(file_links)
+    validate_files(html_links)
+    if scanner is None:
+        scanner = DirScanner()
+    links = [(f, _file_to_shock_params) for f in file_links]
+    links += [(f, _html_to_shock_params) for f in html_links]
+    digest = hashlib.sha256()
+    for (each_file, get_params) in links:
+        if 'path' not in each_file:
+            _update_digest(digest, '')
+            continue
+        params = get_params(each_file)
+        manifest = scanner.scan(params['file_path'], digests=True)
+        _update_digest(digest, _path_digest(manifest, params['pack'], each_file.get('name')))
+    return digest.hexdigest()
+
+
+def estimate_size(file_links, html_links, scanner=None):
     """
-    out_files = []
-    validate_files(files)  # Assures that every file has either a 'path' or 'shock_id'
-    for each_file in files:
+    Count the bytes and files in the paths of some links, before anything is zipped or uploaded
+    Links to existing shock nodes are counted with no bytes and no files
+    :param file_links: list of file dictionaries for `file_links`
+    :param html_links: list of file dictionaries for `html_links`
+    :param scanner: optional DirScanner (see ./dir_scan.py) to scan the paths with
+    :return: dict with the total 'bytes' and 'files', and 'links': a list with the 'name',
+        'bytes' and 'files' of each link, in the order of file_links then html_links
+    """
+    validate_files(file_links)
+    validate_files(html_links)
+    if scanner is None:
+        scanner = DirScanner()
+    links = []
+    for each_file in file_links + html_links:
+        (size, count) = (0, 0)
         if 'path' in each_file:
-            # Having a 'path' key means we have to upload to shock
-            if os.path.isfile(each_file['path']):
-                # If it is not a directory, we have to move it into one before zipping
-                new_dir = os.path.join(os.path.dirname(each_file['path']), str(uuid4()))
-                os.makedirs(new_dir)
-                os.chmod(new_dir, 0o775)
-                # Move the file to dir/name
-                new_path = os.path.join(new_dir, each_file['name'])
-                shutil.copy2(each_file['path'], new_path)
-                each_file['path'] = new_dir
-            shock = dfu.file_to_shock({
-                'file_path': each_file['path'],
-                'make_handle': 1,
-                'pack': 'zip'  # Always zip for HTML
-            })
-        elif 'shock_id' in each_file:
-            # Having a 'shock_id' means it is already uploaded
-            shock = dfu.own_shock_node({'shock_id': each_file['shock_id'], 'make_handle': 1})
-        out_files.append(_create_file_link(each_file, shock))
-    return out_files
+            manifest = scanner.scan(each_file['path'])
+            (size, count) = (manifest.size, len(manifest.files))
+        links.append({'name': each_file.get('name'), 'bytes': size, 'files': count})
+    return {
+        'bytes': sum(link['bytes'] for link in links),
+        'files': sum(link['files'] for link in links),
+        'links': links
+    }
+
+
+def _own_shock_node(dfu, links, cache=None, timer=None, journal=None, scanner=None,
+                    scratch=None):
+    """ Take ownership of a single already-uploaded file """
+    [(each_file, _)] = links
+    return [_call_dfu([each_file], dfu.own_shock_node,
+                      {'shock_id': each_file['shock_id'], 'make_handle': 1})]
+
+
+def _file_to_shock(dfu, links, cache=None, timer=None, journal=None, scanner=None,
+                   scratch=None):
+    """ Upload a single file path with file_to_shock """
+    return _upload_paths(dfu, links, cache, timer, journal, scanner, scratch,
+                         lambda files, params: [_call_dfu(files, dfu.file_to_shock, params[0])])
+
+
+def _file_to_shock_mass(dfu, links, cache=None, timer=None, journal=None, scanner=None,
+                        scratch=None):
+    """ Upload a group of file paths with a single file_to_shock_mass call """
+    return _upload_paths(dfu, links, cache, timer, journal, scanner, scratch,
+                         lambda files, params: _call_dfu(files, dfu.file_to_shock_mass, params))
+
+
+def _upload_paths(dfu, links, cache, timer, journal, scanner, scratch, upload):
+    """
+    Upload the paths for some links, reusing cached shock nodes for content we have seen before
+    Paths already uploaded for this report, according to the journal, are skipped entirely
+    :param upload: function taking lists of files and file_to_shock params for the files that
+        still need uploading, and returning their shock info in the same order
+    :return: list of shock info for every link
+    """
+    files = [each_file for (each_file, _) in links]
+    params = [get_params(each_file) for (each_file, get_params) in links]
+    manifests = [scanner.scan(file_params['file_path']) for file_params in params]
+    shocks = [None] * len(links)
+    digests = [None] * len(links)
+    if journal is not None:
+        for (idx, (each_file, file_params)) in enumerate(zip(files, params)):
+            shocks[idx] = journal.get(manifests[idx], file_params['pack'], each_file.get('name'))
+    journaled = [shock is not None for shock in shocks]
+    if cache is not None:
+        for (idx, (each_file, file_params)) in enumerate(zip(files, params)):
+            if journaled[idx]:
+                continue
+            manifests[idx] = scanner.scan(file_params['file_path'], digests=True)
+            digests[idx] = _path_digest(manifests[idx], file_params['pack'],
+                                        each_file.get('name'))
+            shock_id = cache.get(digests[idx])
+            if not shock_id:
+                continue
+            try:
+                shocks[idx] = dfu.own_shock_node({'shock_id': shock_id, 'make_handle': 1})
+            except _DFUError as err:
+                # The cached node may have been deleted; fall back to uploading the file
+                print(str(_time.time()) + ' Cached shock node ' + shock_id +
+                      ' could not be reused: ' + str(err))
+                cache.remove(digests[idx])
+    missing = [idx for (idx, shock) in enumerate(shocks) if shock is None]
+    if missing:
+        packed = []
+        try:
+            for idx in missing:
+                start = _time.time()
+                packed.append(_pack(params[idx], files[idx].get('name'), manifests[idx],
+                                    scratch))
+                if timer is not None and packed[-1][1]:
+                    timer.add('zip', _time.time() - start)
+            uploaded = upload([files[idx] for idx in missing],
+                              [file_params for (file_params, _) in packed])
+        finally:
+            for (_, tmp_dir) in packed:
+                if tmp_dir:
+                    shutil.rmtree(tmp_dir, ignore_errors=True)
+        if timer is not None:
+            timer.count('uploaded_bytes', sum(shock.get('size') or 0 for shock in uploaded))
+        for (idx, shock) in zip(missing, uploaded):
+            shocks[idx] = shock
+            if digests[idx]:
+                cache.add(digests[idx], shock['shock_id'])
+    if journal is not None:
+        for (idx, (each_file, file_params)) in enumerate(zip(files, params)):
+            if not journaled[idx]:
+                journal.add(manifests[idx], file_params['pack'], each_file.get('name'),
+                            shocks[idx])
+    return shocks
+
+
+def _pack(params, name, manifest, scratch=None):
+    """
+    Zip a path ourselves (see ./pack_utils.py) instead of with DataFileUtil's pack='zip'
+    A directory is zipped with all of its content, while a single file is written straight
+    into the archive as an entry called `name`, without copying it anywhere first. The archive
+    itself is still written in full before it is uploaded, so until then the path takes up
+    about twice its (compressed) size on disk.
+    :param params: file_to_shock parameters
+    :param name: archive entry name to use when the path is a single file, or None to use
+        the file's basename
+    :param manifest: Manifest of the path (see ./dir_scan.py)
+    :param scratch: directory to create the archive's temporary directory in, or None for the
+        directory holding the path
+    :return: tuple of (file_to_shock parameters for the packed file, temporary directory that
+        holds the zip file and should be removed after uploading, or None)
+    """
+    if params.get('pack') != 'zip':
+        return (params, None)
+    path = os.path.normpath(params['file_path'])
+    tmp_dir = os.path.join(scratch or os.path.dirname(path), str(uuid4()))
+    os.makedirs(tmp_dir)
+    os.chmod(tmp_dir, 0o775)
+    zip_path = os.path.join(tmp_dir, os.path.basename(path) + '.zip')
+    try:
+        if manifest.isdir:
+            zip_directory(path, zip_path, manifest)
+        else:
+            zip_file(path, name, zip_path)
+    except Exception:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+        raise
+    return (dict(params, file_path=zip_path, pack=None), tmp_dir)
+
+
+def _file_to_shock_params(each_file):
+    """ Get the file_to_shock parameters for an entry from `file_links` """
+    # Only zip if the path is a directory
+    isdir = os.path.isdir(each_file['path'])
+    return {
+        'file_path': each_file['path'],
+        'make_handle': 1,
+        'pack': 'zip' if isdir else None
+    }
+
+
+def _html_to_shock_params(each_file):
+    """
+    Get the file_to_shock parameters for an entry from `html_links`
+    If the path is a single file, it gets zipped as an entry named by the link's 'name'
+    """
+    return {
+        'file_path': each_file['path'],
+        'make_handle': 1,
+        'pack': 'zip'  # Always zip for HTML
+    }
+
+
+def _path_digest(manifest, pack, name=None):
+    """
+    Compute a SHA-256 digest identifying what file_to_shock would upload for a path
+    For a file, this covers its content and the name it is uploaded under: its basename, or
+    `name` when it gets zipped. For a directory, this covers the relative path and content of
+    every file inside it, but not the name of the directory itself.
+    :param manifest: Manifest of the path, with digests (see ./dir_scan.py)
+    """
+    digest = hashlib.sha256()
+    _update_digest(digest, str(pack))
+    if not manifest.isdir:
+        # Zipped files are stored under their link's name, if it has one (see _pack)
+        basename = os.path.basename(manifest.path)
+        _update_digest(digest, (name or basename) if pack == 'zip' else basename)
+    for (relpath, size, _, file_digest) in manifest.files:
+        if manifest.isdir:
+            _update_digest(digest, relpath)
+        _update_digest(digest, str(size) + ' ' + file_digest)
+    return digest.hexdigest()
+
+
+def _update_digest(digest, text):
+    """ Add a null-terminated string to a digest """
+    if isinstance(text, unicode):
+        text = text.encode('utf-8')
+    digest.update(text + '\0')
+
+
+def _call_dfu(files, method, params):
+    """
+    Call a DataFileUtil method for some files
+    :raises UploadError: naming the links that failed, with the traceback of the original error
+    """
+    try:
+        return method(params)
+    except Exception as err:
+        traceback = sys.exc_info()[2]
+        names = u', '.join(
+            u'"%s" (%s)' % (_text(f.get('name', '')), _text(f.get('path', f.get('shock_id'))))
+            for f in files
+        )
+        message = u'DataFileUtil exception for ' + names + u': ' + _text(err)
+        print(str(_time.time()) + ' ' + message.encode('utf-8'))
+        raise UploadError(message.encode('utf-8'), err), None, traceback
+
+
+def _text(value):
+    """ Get a value as unicode for error messages, whether it is unicode or UTF-8 """
+    if isinstance(value, unicode):
+        return value
+    if not isinstance(value, str):
+        try:
+            value = str(value)
+        except UnicodeEncodeError:
+            return unicode(value)
+    return value.decode('utf-8', 'replace')
+
+
+def _run_concurrently(func, items, max_workers):
+    """
+    Call `func` on every item using a pool of at most `max_workers` threads
+    Results are returned in the same order as `items`. As soon as any call raises
+    an exception, no more calls are started and that exception is re-raised.
+    """
+    if max_workers <= 1 or len(items) <= 1:
+        return [func(item) for item in items]
+    results = [None] * len(items)
+    pool = ThreadPool(min(max_workers, len(items)))
+    try:
+        # imap_unordered yields in completion order, so the first failure surfaces immediately
+        for (idx, result) in pool.imap_unordered(lambda (i, item): (i, func(item)),
+                                                 enumerate(items)):
+            results[idx] = result
+    finally:
+        pool.terminate()
+    return results
 
 
 def _create_file_link(file_data, shock):
@@ -0,0 +1,117 @@
+# -*- coding: utf-8 -*-
+import threading as _threading
+from collections import OrderedDict
+
+from timing_utils import DEFAULT_BUCKETS, Histogram
+
+"""
+Counters, gauges and histograms for monitoring the service
+Metrics are rendered in the Prometheus text exposition format, which the server returns for
+GET requests to its metrics path (see KBaseReportPyServer.Application)
+https://prometheus.io/docs/instrumenting/exposition_formats/
+"""
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+
+class Metrics(object):
+    ''' A thread-safe registry of named metrics, each with a value per set of labels. '''
+
+    def __init__(self):
+        self._lock = _threading.Lock()
+        # name -> [type, help text, histogram buckets, {label tuple: value or Histogram}]
+        self._metrics = OrderedDict()
+
+    def counter(self, name, help_text):
+        """ Register a counter, which only goes up (use inc) """
+        self._register(name, 'counter', help_text)
+
+    def gauge(self, name, help_text):
+        """ Register a gauge, which can be set or go up and down (use set, inc and dec) """
+        self._register(name, 'gauge', help_text)
+
+    def histogram(self, name, help_text, buckets=DEFAULT_BUCKETS):
+        """ Register a histogram of observed values (use observe) """
+        self._register(name, 'histogram', help_text, buckets)
+
+    def inc(self, name, value=1, **labels):
+        """ Add `value` to a counter or gauge """
+        key = _label_key(labels)
+        with self._lock:
+            values = self._metrics[name][3]
+            values[key] = values.get(key, 0) + value
+
+    def dec(self, name, value=1, **labels):
+        """ Subtract `value` from a gauge """
+        self.inc(name, -value, **labels)
+
+    def set(self, name, value, **labels):
+        """ Set the value of a gauge, or of a counter that is tracked elsewhere """
+        with self._lock:
+            self._metrics[name][3][_label_key(labels)] = value
+
+    def observe(self, name, value, **labels):
+        """ Add a value to a histogram """
+        key = _label_key(labels)
+        with self._lock:
+            (_, _, buckets, values) = self._metrics[name]
+            histogram = values.get(key)
+            if histogram is None:
+                histogram = values[key] = Histogram(buckets)
+        histogram.observe(value)
+
+    def render(self):
+        """ :return: every metric as a string in the Prometheus text format """
+        with self._lock:
+            metrics = [(name, type_name, help_text, sorted(values.items()))
+                       for (name, (type_name, help_text, _, values)) in self._metrics.items()]
+        lines = []
+        for (name, type_name, help_text, values) in metrics:
+            lines.append('# HELP ' + name + ' ' + help_text.replace('\\', '\\\\'))
+            lines.append('# TYPE ' + name + ' ' + type_name)
+            for (key, value) in values:
+                if type_name == 'histogram':
+                    lines += _histogram_lines(name, key, value)
+                else:
+                    lines.append(name + _format_labels(key) + ' ' + _format_value(value))
+        return '\n'.join(lines) + '\n'
+
+    def _register(self, name, type_name, help_text, buckets=None):
+        with self._lock:
+            if name not in self._metrics:
+                self._metrics[name] = [type_name, help_text, buckets, {}]
+
+
+def _label_key(labels):
+    """ Hashable, ordered key for a dict of label names and values """
+    return tuple(sorted((name, str(value)) for (name, value) in labels.items()))
+
+
+def _histogram_lines(name, key, histogram):
+    """ Lines for the buckets, sum and count of one labelled histogram """
+    snapshot = histogram.snapshot()
+    lines = []
+    for bound in histogram.buckets:
+        le = repr(float(bound))
+        lines.append(name + '_bucket' + _format_labels(key + (('le', le),)) + ' ' +
+                     str(snapshot['buckets'][le]))
+    lines.append(name + '_bucket' + _format_labels(key + (('le', '+Inf'),)) + ' ' +
+                 str(snapshot['count']))
+    lines.append(name + '_sum' + _format_labels(key) + ' ' + _format_value(snapshot['sum']))
+    lines.append(name + '_count' + _format_labels(key) + ' ' + str(snapshot['count']))
+    return lines
+
+
+def _format_labels(key):
+    """ Format labels as {name="value",...}, escaping the values """
+    if not key:
+        return ''
+    escaped = [(name, value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n'))
+               for (name, value) in key]
+    return '{' + ','.join(name + '="' + value + '"' for (name, value) in escaped) + '}'
+
+
+def _format_value(value):
+    if isinstance(value, float):
+        return repr(value)
+    return str(value)
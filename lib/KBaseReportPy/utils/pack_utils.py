@@ -0,0 +1,57 @@
+# -*- coding: utf-8 -*-
+import os
+import zipfile
+
+from dir_scan import scan
+
+"""
+Utilities for packing directories before they are uploaded
+We zip directories ourselves, rather than with DataFileUtil's `pack: 'zip'`, so that we can
+choose the compression for each file and remove the archive as soon as it has been uploaded
+"""
+
+# Formats that are already compressed, so deflating them again only costs time
+_COMPRESSED_EXTENSIONS = frozenset([
+    '.png', '.jpg', '.jpeg', '.gif', '.webp', '.svgz',
+    '.gz', '.tgz', '.bz2', '.xz', '.zip', '.7z',
+    '.woff', '.woff2', '.mp3', '.mp4', '.webm'
+])
+
+
+def zip_directory(dir_path, zip_path, manifest=None):
+    """
+    Write a zip archive containing every file inside a directory
+    Paths in the archive are relative to the directory, matching DataFileUtil's zip packing
+    :param dir_path: directory to pack
+    :param zip_path: path of the zip file to write
+    :param manifest: Manifest of the directory (see ./dir_scan.py), if it was already scanned
+    :return: zip_path
+    """
+    if manifest is None:
+        manifest = scan(dir_path)
+    with zipfile.ZipFile(zip_path, 'w', zipfile.ZIP_DEFLATED, allowZip64=True) as archive:
+        # Files are streamed into the archive one at a time, in the order of the manifest
+        for (path, arcname) in manifest.abspaths():
+            archive.write(path, arcname, _compress_type(arcname))
+    return zip_path
+
+
+def zip_file(path, arcname, zip_path):
+    """
+    Write a zip archive containing a single file, read directly from where it already is
+    :param path: file to pack
+    :param arcname: name of the file inside the archive, or None for the file's basename
+    :param zip_path: path of the zip file to write
+    :return: zip_path
+    """
+    if not arcname:
+        arcname = os.path.basename(path)
+    with zipfile.ZipFile(zip_path, 'w', zipfile.ZIP_DEFLATED, allowZip64=True) as archive:
+        archive.write(path, arcname, _compress_type(arcname))
+    return zip_path
+
+
+def _compress_type(filename):
+    """ Store files that are already compressed; deflate everything else """
+    ext = os.path.splitext(filename)[1].lower()
+    return zipfile.ZIP_STORED if ext in _COMPRESSED_EXTENSIONS else zipfile.ZIP_DEFLATED
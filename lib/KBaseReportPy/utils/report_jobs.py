@@ -0,0 +1,274 @@
+# -*- coding: utf-8 -*-
+import errno
+import json
+import os
+import socket
+import threading as _threading
+import time as _time
+import traceback
+from uuid import UUID, uuid4
+
+"""
+A table of report creation jobs, with the state of each job kept in its own file
+create_extended_report_submit starts a job in the process that received it and returns its ID
+right away, and check_report_job polls its progress until the result is ready. Since the state
+is read from the job's file, the check can be served by any process that shares the directory.
+Each result is returned once, and finished jobs that nobody checks are removed after a while.
+"""
+
+QUEUED = 'queued'
+RUNNING = 'running'
+COMPLETED = 'completed'
+ERROR = 'error'
+
+# Minimum number of seconds between writes of a running job's progress
+_SAVE_INTERVAL_SEC = 1
+
+_HOST = socket.gethostname()
+
+
+class ReportJobs(object):
+    ''' Report jobs by ID, each running on its own thread and saved to a file per job. '''
+
+    def __init__(self, directory, max_workers=2, ttl_sec=60 * 60):
+        """
+        :param directory: directory holding a file for each job; created when the first job is
+            submitted. Every process serving check_report_job must be able to read it.
+        :param max_workers: maximum number of jobs to run at the same time in this process;
+            others are queued
+        :param ttl_sec: number of seconds a finished job is kept for if its result isn't checked
+        """
+        self._dir = directory
+        self._ttl_sec = ttl_sec
+        self._slots = _threading.BoundedSemaphore(max_workers)
+
+    def submit(self, owner, func):
+        """
+        Start a thread that calls `func(progress)` once one of the max_workers slots is free
+        The thread isn't a daemon, so a process that exits right after submitting (such as the
+        async CLI, which runs a single call) finishes the job first.
+        :param owner: user the job belongs to; only they can check it
+        :param func: function taking a JobProgress and returning the result of the job
+        :return: ID of the new job
+        """
+        try:
+            os.makedirs(self._dir)
+        except OSError:
+            if not os.path.isdir(self._dir):
+                raise
+        self._collect()
+        job = _Job(self._dir, owner)
+        job.save()
+        thread = _threading.Thread(target=self._run, args=(job, func))
+        thread.start()
+        return job.job_id
+
+    def check(self, owner, job_id):
+        """
+        Get the status and progress of a job
+        Once a job has completed or failed, its status is returned once and the job is removed
+        :param owner: user checking the job
+        :param job_id: ID returned by submit
+        :return: dict of 'job_id', 'status' (queued, running, completed or error), 'files_done',
+            'files_total', 'bytes_done' and 'bytes_total', plus 'result' when the job completed
+            or 'error' when it failed
+        """
+        self._collect()
+        path = self._path(job_id)
+        state = _read(path) if path else None
+        if state is None or state['owner'] != owner:
+            raise ValueError('Unknown report job ' + str(job_id) +
+                             ': it may have expired or its result was already returned')
+        if state['status'] in (QUEUED, RUNNING) and _stopped(state):
+            state['status'] = ERROR
+            state['error'] = 'The server process running the job stopped before it finished'
+        if state['status'] in (COMPLETED, ERROR):
+            # Only the process that manages to move the file returns the final status
+            claimed = path + '.' + str(uuid4())
+            try:
+                os.rename(path, claimed)
+            except OSError:
+                raise ValueError('Unknown report job ' + str(job_id) +
+                                 ': it may have expired or its result was already returned')
+            os.remove(claimed)
+        status = dict((key, state[key]) for key in
+                      ('job_id', 'status', 'files_done', 'files_total', 'bytes_done',
+                       'bytes_total'))
+        if state['status'] == COMPLETED:
+            status['result'] = state['result']
+        elif state['status'] == ERROR:
+            status['error'] = state['error']
+        return status
+
+    def stats(self):
+        """ Get the number of jobs in the directory with each status """
+        self._collect()
+        counts = dict((status, 0) for status in (QUEUED, RUNNING, COMPLETED, ERROR))
+        for state in self._states():
+            counts[state['status']] += 1
+        return counts
+
+    def _run(self, job, func):
+        with self._slots:
+            job.run(func)
+
+    def _path(self, job_id):
+        """ :return: path of the file for a job, or None if job_id isn't a valid job ID """
+        try:
+            if str(UUID(job_id)) != job_id:
+                return None
+        except (TypeError, ValueError):
+            return None
+        return os.path.join(self._dir, job_id + '.json')
+
+    def _states(self):
+        """ :return: the state saved in every job file that can be read """
+        try:
+            names = os.listdir(self._dir)
+        except OSError:
+            return []
+        states = [_read(os.path.join(self._dir, name)) for name in names
+                  if name.endswith('.json')]
+        return [state for state in states if state is not None]
+
+    def _collect(self):
+        """
+        Remove jobs that finished more than ttl_sec ago, or whose process stopped running them,
+        along with files left behind by processes that stopped while writing them
+        Unfinished jobs from other hosts are removed once their progress hasn't changed for
+        ttl_sec, since there's no telling whether their process is still running.
+        """
+        expiry = _time.time() - self._ttl_sec
+        try:
+            names = os.listdir(self._dir)
+        except OSError:
+            return
+        for name in names:
+            path = os.path.join(self._dir, name)
+            try:
+                if os.path.getmtime(path) >= expiry:
+                    continue
+                state = _read(path) if name.endswith('.json') else None
+                if (state is None or state['status'] in (COMPLETED, ERROR) or
+                        state['host'] != _HOST or _stopped(state)):
+                    os.remove(path)
+            except OSError:
+                # Removed by another process
+                pass
+
+
+class JobProgress(object):
+    ''' Number of files and bytes that a job has uploaded, out of its totals. '''
+
+    def __init__(self, on_change=None):
+        """
+        :param on_change: optional function called after each change, with True when the
+            totals were set and False when files were added
+        """
+        self._lock = _threading.Lock()
+        self._on_change = on_change
+        self.files_done = 0
+        self.files_total = 0
+        self.bytes_done = 0
+        self.bytes_total = 0
+
+    def start(self, files_total, bytes_total):
+        """ Set the totals, once they are known """
+        with self._lock:
+            self.files_total = files_total
+            self.bytes_total = bytes_total
+        if self._on_change:
+            self._on_change(True)
+
+    def add(self, files, num_bytes):
+        """ Record some finished files """
+        with self._lock:
+            self.files_done += files
+            self.bytes_done += num_bytes
+        if self._on_change:
+            self._on_change(False)
+
+    def snapshot(self):
+        """ :return: dict of 'files_done', 'files_total', 'bytes_done' and 'bytes_total' """
+        with self._lock:
+            return {'files_done': self.files_done, 'files_total': self.files_total,
+                    'bytes_done': self.bytes_done, 'bytes_total': self.bytes_total}
+
+
+class _Job(object):
+    ''' A single job, run by this process, which writes its state to the job's file. '''
+
+    def __init__(self, directory, owner):
+        self.job_id = str(uuid4())
+        self.path = os.path.join(directory, self.job_id + '.json')
+        self.owner = owner
+        self.state = QUEUED
+        self.progress = JobProgress(self._progressed)
+        self.result = None
+        self.error = None
+        self._lock = _threading.Lock()
+        self._saved = 0
+        # Set once the final state is saved, after which check_report_job may remove the file
+        self._finished = False
+
+    def run(self, func):
+        try:
+            self.state = RUNNING
+            self.save()
+            self.result = func(self.progress)
+            self.state = COMPLETED
+        except BaseException as err:
+            # Anything raised, including SystemExit, fails the job so it isn't left running
+            print(str(_time.time()) + ' Report job ' + self.job_id + ' failed:\n' +
+                  traceback.format_exc())
+            self.error = str(err) or type(err).__name__
+            self.state = ERROR
+        self.save(final=True)
+
+    def save(self, final=False):
+        """ Replace the job's file with its current state, unless the final state was saved """
+        state = self.progress.snapshot()
+        state.update({'job_id': self.job_id, 'owner': self.owner, 'status': self.state,
+                      'result': self.result, 'error': self.error,
+                      'host': _HOST, 'pid': os.getpid()})
+        with self._lock:
+            if self._finished:
+                return
+            self._finished = final
+            tmp_path = self.path + '.' + str(uuid4())
+            with open(tmp_path, 'w') as fd:
+                json.dump(state, fd)
+            os.rename(tmp_path, self.path)
+            self._saved = _time.time()
+
+    def _progressed(self, started):
+        """
+        Save the progress of the running job as soon as its totals are known, and then at most
+        every _SAVE_INTERVAL_SEC seconds as files are added
+        """
+        if started or _time.time() - self._saved >= _SAVE_INTERVAL_SEC:
+            self.save()
+
+
+def _read(path):
+    """ :return: the state saved in a job file, or None if there isn't one """
+    try:
+        with open(path) as fd:
+            return json.load(fd)
+    except (IOError, ValueError):
+        return None
+
+
+def _stopped(state):
+    """
+    Whether the process running an unfinished job has exited
+    This can only be told for processes on the same host; jobs run elsewhere are assumed to
+    still be running until they expire.
+    """
+    if state['host'] != _HOST:
+        return False
+    try:
+        os.kill(state['pid'], 0)
+    except OSError as err:
+        return err.errno == errno.ESRCH
+    return False
@@ -0,0 +1,50 @@
+# -*- coding: utf-8 -*-
+import threading as _threading
+import time as _time
+from collections import OrderedDict
+
+"""
+An in-process cache of the reports saved in idempotent mode
+Maps the workspace, report_object_name and params hash of a report to its reference, so that a
+retried create_extended_report returns the same report without calling the workspace at all
+"""
+
+
+class ReportRefCache(object):
+    ''' A size-limited map from report key to report reference whose entries expire. '''
+
+    def __init__(self, maxsize=1000, ttl_sec=10 * 60):
+        """
+        :param maxsize: maximum number of reports to keep; the oldest are evicted first
+        :param ttl_sec: number of seconds after which a report is looked up in the workspace again
+        """
+        self._maxsize = maxsize
+        self._ttl_sec = ttl_sec
+        self._lock = _threading.Lock()
+        # Ordered from oldest to newest: key -> [ref, time added]
+        self._cache = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        """ Get the reference cached for a key, or None """
+        with self._lock:
+            entry = self._cache.get(key)
+            if entry and _time.time() - entry[1] <= self._ttl_sec:
+                self.hits += 1
+                return entry[0]
+            self.misses += 1
+            return None
+
+    def add(self, key, ref):
+        """ Cache the reference of a report that was saved or found """
+        with self._lock:
+            self._cache.pop(key, None)
+            self._cache[key] = [ref, _time.time()]
+            while len(self._cache) > self._maxsize:
+                self._cache.popitem(last=False)
+
+    def stats(self):
+        """ Get the number of workspace lookups saved (hits), made (misses), and cached reports """
+        with self._lock:
+            return {'hits': self.hits, 'misses': self.misses, 'size': len(self._cache)}
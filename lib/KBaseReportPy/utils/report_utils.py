@@ -1,21 +1,35 @@
 # -*- coding: utf-8 -*-
-from file_utils import fetch_or_upload_file_links, fetch_or_upload_html_links
+from async_utils import run_steps
+from file_utils import content_digest, fetch_or_upload_links
+import hashlib
+import json
+import threading
 import time as _time
 from DataFileUtil.baseclient import ServerError as _DFUError
 from uuid import uuid4
 
 """ Utilities for creating reports using DataFileUtil """
 
+# Maximum number of reports to save in a single save_objects call
+_SAVE_OBJECTS_CHUNK_SIZE = 100
 
-def create_report(params, dfu):
+# Key in the metadata of a report saved in idempotent mode that holds its report_hash()
+REPORT_HASH_META_KEY = 'report_hash'
+
+# Parameters that don't change the report that gets saved, so report_hash() ignores them
+_UNHASHED_PARAMS = frozenset(['debug', 'idempotent', 'idempotency_key'])
+
+
+def create_report(params, dfu, ws_cache=None):
     """
     Create a simple report
     :param params: see the KIDL spec for the create() parameters
     :param dfu: instance of DataFileUtil
+    :param ws_cache: optional WorkspaceIdCache for workspace name lookups
     :return: report data
     """
     report_name = "report_" + str(uuid4())
-    workspace_id = _get_workspace_id(dfu, params)
+    workspace_id = _get_workspace_id(dfu, params, ws_cache)
     # Empty defaults for merging
     report_data = {
         'objects_created': []
@@ -23,32 +37,196 @@ def create_report(params, dfu):
     report_data.update(params['report'])
     save_object_params = {
         'id': workspace_id,
-        'objects': [{
-            'type': 'KBaseReport.Report',
-            'data': report_data,
-            'name': report_name,
-            'meta': {},
-            'hidden': 1
-        }]
+        'objects': [_report_object(report_data, report_name)]
     }
     obj = _save_object(dfu, save_object_params)
     ref = _get_object_ref(obj)
     return {'ref': ref, 'name': report_name}
 
 
-def create_extended(params, dfu):
+def create_extended(params, dfu, max_workers=1, batch_size=0, cache=None, ws_cache=None,
+                    timer=None, progress=None, journal=None, meta=None, scanner=None,
+                    scratch=None, preflight=None):
     """
     Create an extended report
     This will upload files to shock if you provide scratch paths instead of shock_ids
     :param params: see the KIDL spec for create_extended_report() parameters
     :param dfu: instance of DataFileUtil
+    :param max_workers: maximum number of file uploads to run at the same time
+    :param batch_size: number of paths to upload per file_to_shock_mass call (0 disables batching)
+    :param cache: optional UploadCache for reusing shock nodes of previously uploaded files
+    :param ws_cache: optional WorkspaceIdCache for workspace name lookups
+    :param timer: optional StageTimer (see ./timing_utils.py) for the time taken by each step
+    :param progress: optional JobProgress (see ./report_jobs.py) for the files uploaded so far
+    :param journal: optional UploadJournal (see ./upload_journal.py) of the uploads done so far
+    :param meta: optional workspace metadata to save the report with
+    :param scanner: optional DirScanner (see ./dir_scan.py) holding the manifests of paths that
+        were already scanned for this report
+    :param scratch: directory to write zip files to before uploading them (see ./file_utils.py)
+    :param preflight: optional function checking the report's paths, which runs alongside the
+        workspace lookup and must return before any upload starts
     :return: uploaded report data - {'ref': r, 'name': n}
     """
     file_links = params.get('file_links', [])
     html_links = params.get('html_links', [])
-    files = fetch_or_upload_file_links(dfu, file_links)  # see ./file_utils.py
-    html_files = fetch_or_upload_html_links(dfu, html_links)
-    report_data = {
+    report_name = params.get('report_object_name', 'report_' + str(uuid4()))
+
+    def save(workspace_id, (files, html_files)):
+        report_data = _extended_report_data(params, files, html_files)
+        save_object_params = {
+            'id': workspace_id,
+            'objects': [_report_object(report_data, report_name, meta)]
+        }
+        return _get_object_ref(_save_object(dfu, save_object_params))
+
+    # The workspace lookup is independent of checking and uploading the paths, so they run at
+    # the same time; see ./async_utils.py and ./file_utils.py
+    # When a step fails, the uploads stop before their next file
+    cancel = threading.Event()
+    results = run_steps(_with_preflight(preflight, [
+        ('workspace_id', [], lambda: _get_workspace_id(dfu, params, ws_cache)),
+        ('upload', [], lambda: fetch_or_upload_links(dfu, file_links, html_links, max_workers,
+                                                     batch_size, cache, timer, progress,
+                                                     journal, scanner, scratch, cancel)),
+        ('save', ['workspace_id', 'upload'], save)
+    ]), timer, cancel)
+    return {'ref': results['save'], 'name': report_name}
+
+
+def create_extended_many(params_list, dfu, max_workers=1, batch_size=0, cache=None,
+                         ws_cache=None, timer=None, scanner=None, scratch=None,
+                         preflight=None):
+    """
+    Create many extended reports at once
+    The files for every report share the same upload pool, and the reports are saved with one
+    save_objects call per workspace (split into chunks of _SAVE_OBJECTS_CHUNK_SIZE objects)
+    :param params_list: list of create_extended_report() parameters (see the KIDL spec)
+    :param dfu: instance of DataFileUtil
+    :param max_workers: maximum number of file uploads to run at the same time
+    :param batch_size: number of paths to upload per file_to_shock_mass call (0 disables batching)
+    :param cache: optional UploadCache for reusing shock nodes of previously uploaded files
+    :param ws_cache: optional WorkspaceIdCache for workspace name lookups
+    :param timer: optional StageTimer (see ./timing_utils.py) for the time taken by each step
+    :param scanner: optional DirScanner (see ./dir_scan.py) holding the manifests of paths that
+        were already scanned for these reports
+    :param scratch: directory to write zip files to before uploading them (see ./file_utils.py)
+    :param preflight: optional function checking the paths of every report (see create_extended)
+    :return: list of uploaded report data - {'ref': r, 'name': n} - in the order of params_list
+    """
+    file_links = []
+    html_links = []
+    for params in params_list:
+        file_links += params.get('file_links', [])
+        html_links += params.get('html_links', [])
+    # The workspace lookups and the uploads are independent, so they run at the same time
+    # see ./async_utils.py and ./file_utils.py
+    cancel = threading.Event()
+    results = run_steps(_with_preflight(preflight, [
+        ('workspace_id', [], lambda: [_get_workspace_id(dfu, p, ws_cache) for p in params_list]),
+        ('upload', [], lambda: fetch_or_upload_links(dfu, file_links, html_links,
+                                                     max_workers, batch_size, cache, timer,
+                                                     scanner=scanner, scratch=scratch,
+                                                     cancel=cancel)),
+        ('save', ['workspace_id', 'upload'],
+         lambda workspace_ids, uploaded: _save_many(dfu, params_list, workspace_ids, uploaded))
+    ]), timer, cancel)
+    return results['save']
+
+
+def _with_preflight(preflight, steps):
+    """ Add a 'preflight' step to the steps of a report, which the 'upload' step waits for """
+    if preflight is None:
+        return steps
+    with_preflight = [('preflight', [], preflight)]
+    for (name, deps, func) in steps:
+        if name == 'upload':
+            (deps, func) = (['preflight'], lambda _, func=func: func())
+        with_preflight.append((name, deps, func))
+    return with_preflight
+
+
+def report_hash(params, scanner=None):
+    """
+    Compute a SHA-256 digest of the parameters of an extended report and the content of its paths
+    Two reports with the same hash would be saved with the same data
+    :param params: see the KIDL spec for create_extended_report() parameters
+    :param scanner: optional DirScanner (see ./dir_scan.py) to scan and hash the paths with
+    :return: hex digest
+    """
+    hashed = dict((key, val) for (key, val) in params.items() if key not in _UNHASHED_PARAMS)
+    digest = hashlib.sha256()
+    digest.update(json.dumps(hashed, sort_keys=True) + '\0')
+    digest.update(content_digest(params.get('file_links', []), params.get('html_links', []),
+                                 scanner))
+    return digest.hexdigest()
+
+
+def find_report(ws, params, params_hash):
+    """
+    Find the report named by params['report_object_name'], if it was saved with `params_hash`
+    :param ws: Workspace client
+    :param params: see the KIDL spec for create_extended_report() parameters
+    :param params_hash: report_hash() of the params
+    :return: reference to the latest version of the report, or None if there is no report with
+        that name or it was saved from different parameters or files
+    """
+    obj = {'name': params['report_object_name']}
+    if 'workspace_name' in params:
+        obj['workspace'] = params['workspace_name']
+    else:
+        obj['wsid'] = params['workspace_id']
+    info = ws.get_object_info3({'objects': [obj], 'includeMetadata': 1, 'ignoreErrors': 1})
+    info = info['infos'][0]
+    if info and (info[10] or {}).get(REPORT_HASH_META_KEY) == params_hash:
+        return _get_object_ref(info)
+    return None
+
+
+def _save_many(dfu, params_list, workspace_ids, (files, html_files)):
+    """
+    Save the reports for create_extended_many
+    :param dfu: instance of DataFileUtil
+    :param params_list: list of create_extended_report() parameters (see the KIDL spec)
+    :param workspace_ids: workspace ID for each report
+    :param files: uploaded file_links of every report, in order
+    :param html_files: uploaded html_links of every report, in order
+    :return: list of uploaded report data - {'ref': r, 'name': n} - in the order of params_list
+    """
+    # Group the report objects by the workspace they are saved in, keeping their order
+    workspace_order = []
+    objects_by_workspace = {}
+    (files_start, html_start) = (0, 0)
+    for (idx, params) in enumerate(params_list):
+        files_end = files_start + len(params.get('file_links', []))
+        html_end = html_start + len(params.get('html_links', []))
+        report_data = _extended_report_data(params, files[files_start:files_end],
+                                            html_files[html_start:html_end])
+        (files_start, html_start) = (files_end, html_end)
+        report_name = params.get('report_object_name', 'report_' + str(uuid4()))
+        workspace_id = workspace_ids[idx]
+        if workspace_id not in objects_by_workspace:
+            workspace_order.append(workspace_id)
+            objects_by_workspace[workspace_id] = []
+        objects_by_workspace[workspace_id].append((idx, _report_object(report_data, report_name)))
+    infos = [None] * len(params_list)
+    for workspace_id in workspace_order:
+        objects = objects_by_workspace[workspace_id]
+        for start in range(0, len(objects), _SAVE_OBJECTS_CHUNK_SIZE):
+            chunk = objects[start:start + _SAVE_OBJECTS_CHUNK_SIZE]
+            saved = _save_objects(dfu, {'id': workspace_id, 'objects': [o for (_, o) in chunk]})
+            for ((idx, report_obj), obj) in zip(chunk, saved):
+                infos[idx] = {'ref': _get_object_ref(obj), 'name': report_obj['name']}
+    return infos
+
+
+def _extended_report_data(params, files, html_files):
+    """
+    Get the data for a Report object (see KBaseReportPyWorkspace.spec)
+    :param params: see the KIDL spec for create_extended_report() parameters
+    :param files: uploaded file_links
+    :param html_files: uploaded html_links
+    """
+    return {
         'text_message': params.get('message'),
         'file_links': files,
         'html_links': html_files,
@@ -59,29 +237,28 @@ def create_extended(params, dfu):
         'html_window_height': params.get('html_window_height'),
         'summary_window_height': params.get('summary_window_height')
     }
-    report_name = params.get('report_object_name', 'report_' + str(uuid4()))
-    workspace_id = _get_workspace_id(dfu, params)
-    save_object_params = {
-        'id': workspace_id,
-        'objects': [{
-            'type': 'KBaseReport.Report',
-            'data': report_data,
-            'name': report_name,
-            'meta': {},
-            'hidden': 1
-        }]
+
+
+def _report_object(report_data, report_name, meta=None):
+    """ Get the save_objects entry for saving a report """
+    return {
+        'type': 'KBaseReport.Report',
+        'data': report_data,
+        'name': report_name,
+        'meta': meta or {},
+        'hidden': 1
     }
-    obj = _save_object(dfu, save_object_params)
-    ref = _get_object_ref(obj)
-    return {'ref': ref, 'name': report_name}
 
 
-def _get_workspace_id(dfu, params):
+def _get_workspace_id(dfu, params, ws_cache=None):
     """
     Get the workspace ID from the params, which may either have 'workspace_id'
     or 'workspace_name'
+    Names are looked up through `ws_cache` (see ./workspace_cache.py) when it is given
     """
     if 'workspace_name' in params:
+        if ws_cache is not None:
+            return ws_cache.get_id(params['workspace_name'], dfu.ws_name_to_id)
         return dfu.ws_name_to_id(params['workspace_name'])
     else:
         return params.get('workspace_id')
@@ -94,8 +271,13 @@ def _get_object_ref(obj):
 
 def _save_object(dfu, params):
     """ Save an object with DFU using error handling """
+    return _save_objects(dfu, params)[0]
+
+
+def _save_objects(dfu, params):
+    """ Save a list of objects with DFU using error handling """
     try:
-        return dfu.save_objects(params)[0]
+        return dfu.save_objects(params)
     except _DFUError as err:
         print(str(_time.time()) + ' DataFileUtil exception: ' + str(err))
         raise err
@@ -0,0 +1,166 @@
+# -*- coding: utf-8 -*-
+import threading as _threading
+import time as _time
+from contextlib import contextmanager
+
+"""
+Utilities for timing the stages of creating a report
+A StageTimer collects the breakdown for a single call, such as the time spent validating,
+zipping, or waiting on each DataFileUtil method, and StageHistograms aggregates the
+breakdowns of every call so they can be read from the `status` method
+"""
+
+# Upper bounds, in seconds, of the histogram buckets (the same as Prometheus' defaults)
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+# Upper bounds, in seconds, of the buckets for report stages, as uploads can take many minutes
+STAGE_BUCKETS = DEFAULT_BUCKETS + (30, 60, 120, 300, 600, 1800, 3600)
+
+
+class StageTimer(object):
+    '''
+    Total time and number of calls for each stage of a single report creation.
+    Also totals quantities that are only known deep inside a stage, such as bytes uploaded.
+    '''
+
+    def __init__(self):
+        self._lock = _threading.Lock()
+        self._start = _time.time()
+        # stage name -> [number of calls, total seconds]
+        self._stages = {}
+        # quantity name -> total
+        self.totals = {}
+
+    def add(self, stage, seconds):
+        """ Record one call of `stage` that took `seconds` """
+        with self._lock:
+            entry = self._stages.setdefault(stage, [0, 0.0])
+            entry[0] += 1
+            entry[1] += seconds
+
+    def count(self, name, value):
+        """ Add `value` to the total for a quantity, such as 'uploaded_bytes' """
+        with self._lock:
+            self.totals[name] = self.totals.get(name, 0) + value
+
+    @contextmanager
+    def time(self, stage):
+        """ Record the time spent in a `with` block as one call of `stage` """
+        start = _time.time()
+        try:
+            yield
+        finally:
+            self.add(stage, _time.time() - start)
+
+    def wrap(self, client):
+        """
+        Time every method called on a client, such as DataFileUtil, as a stage of its own
+        :return: object with the same methods as `client`
+        """
+        return _TimedClient(client, self)
+
+    def breakdown(self):
+        """
+        Get the time spent in each stage, plus the total time since the timer was created
+        Stages that run in parallel, such as uploads, add up the time of every call
+        :return: dict of stage name to {'count': number of calls, 'seconds': total time}
+        """
+        with self._lock:
+            stages = dict((stage, {'count': count, 'seconds': secs})
+                          for (stage, (count, secs)) in self._stages.items())
+        stages['total'] = {'count': 1, 'seconds': _time.time() - self._start}
+        return stages
+
+    def format(self, breakdown=None):
+        """
+        Format a breakdown for logging, slowest stage first
+        :return: string such as "total=1.514s upload=1.204s file_to_shock=2.390s/2 ..."
+        """
+        breakdown = breakdown or self.breakdown()
+        stages = sorted(breakdown.items(), key=lambda (stage, timing): -timing['seconds'])
+        return ' '.join('%s=%.3fs%s' % (stage, timing['seconds'],
+                                        '/' + str(timing['count']) if timing['count'] > 1 else '')
+                        for (stage, timing) in stages)
+
+
+def seconds_by_stage(breakdown):
+    """ Get just the seconds spent in each stage of a StageTimer breakdown """
+    return dict((stage, timing['seconds']) for (stage, timing) in breakdown.items())
+
+
+class _TimedClient(object):
+    ''' Proxy for a client that records the time of each method call in a StageTimer. '''
+
+    def __init__(self, client, timer):
+        self._client = client
+        self._timer = timer
+
+    def __getattr__(self, name):
+        attr = getattr(self._client, name)
+        if name.startswith('_') or not callable(attr):
+            return attr
+
+        def timed(*args, **kwargs):
+            with self._timer.time(name):
+                return attr(*args, **kwargs)
+        return timed
+
+
+class Histogram(object):
+    ''' Thread-safe count of observed values in cumulative buckets, plus their count and sum. '''
+
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        self.buckets = tuple(sorted(buckets))
+        self._lock = _threading.Lock()
+        self._counts = [0] * len(self.buckets)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value):
+        """ Add a value to the histogram """
+        with self._lock:
+            self.count += 1
+            self.sum += value
+            for (idx, bound) in enumerate(self.buckets):
+                if value <= bound:
+                    self._counts[idx] += 1
+                    break
+
+    def snapshot(self):
+        """
+        :return: dict with the 'count' and 'sum' of every value, and 'buckets', which maps the
+            upper bound of each bucket (as a string, ending with '+Inf') to the cumulative count
+        """
+        with self._lock:
+            (counts, count, total) = (list(self._counts), self.count, self.sum)
+        buckets = []
+        cumulative = 0
+        for (bound, bucket_count) in zip(self.buckets, counts):
+            cumulative += bucket_count
+            buckets.append((repr(float(bound)), cumulative))
+        buckets.append(('+Inf', count))
+        return {'count': count, 'sum': total, 'buckets': dict(buckets)}
+
+
+class StageHistograms(object):
+    ''' Histograms of the time spent in each stage, over every report created. '''
+
+    def __init__(self, buckets=STAGE_BUCKETS):
+        self._buckets = buckets
+        self._lock = _threading.Lock()
+        self._histograms = {}
+
+    def observe(self, breakdown):
+        """ Add the stage times from a StageTimer breakdown """
+        for (stage, timing) in breakdown.items():
+            with self._lock:
+                histogram = self._histograms.get(stage)
+                if histogram is None:
+                    histogram = self._histograms[stage] = Histogram(self._buckets)
+            histogram.observe(timing['seconds'])
+
+    def stats(self):
+        """ :return: dict of stage name to Histogram.snapshot() """
+        with self._lock:
+            histograms = dict(self._histograms)
+        return dict((stage, histogram.snapshot()) for (stage, histogram) in histograms.items())
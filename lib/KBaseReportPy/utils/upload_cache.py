@@ -0,0 +1,116 @@
+# -*- coding: utf-8 -*-
+import json
+import os
+import threading as _threading
+import time as _time
+from collections import OrderedDict
+from uuid import uuid4
+
+"""
+A persistent cache of uploaded file content
+Maps the digest of an uploaded path to the shock node that holds its content, so that
+identical files can be re-linked with DataFileUtil.own_shock_node instead of re-uploaded
+"""
+
+
+class UploadCache(object):
+    ''' A file-backed map from content digest to shock node ID. '''
+
+    def __init__(self, path, maxsize=10000, max_age_sec=24 * 60 * 60):
+        """
+        :param path: JSON file in which the cache is persisted between reports
+        :param maxsize: maximum number of digests to keep; the oldest are evicted first
+        :param max_age_sec: entries older than this many seconds are ignored and evicted
+        """
+        self._path = path
+        self._maxsize = maxsize
+        self._max_age_sec = max_age_sec
+        self._lock = _threading.RLock()
+        # Ordered from oldest to newest: digest -> [shock_id, time added]
+        self._cache = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        with self._lock:
+            self._merge(self._read())
+
+    def get(self, digest):
+        """ Get the shock ID for a digest, or None if it is missing or expired """
+        with self._lock:
+            entry = self._cache.get(digest)
+            if entry and _time.time() - entry[1] > self._max_age_sec:
+                del self._cache[digest]
+                self.evictions += 1
+                entry = None
+            if entry:
+                self.hits += 1
+                return entry[0]
+            self.misses += 1
+            return None
+
+    def add(self, digest, shock_id):
+        """ Record the shock node that was uploaded for a digest """
+        with self._lock:
+            self._cache.pop(digest, None)
+            self._cache[digest] = [shock_id, _time.time()]
+            self.evictions += self._evict()
+
+    def remove(self, digest):
+        """ Forget a digest, such as when its shock node can no longer be used """
+        with self._lock:
+            if self._cache.pop(digest, None):
+                self.evictions += 1
+
+    def save(self):
+        """ Write the cache to disk, merging in entries written by other processes """
+        with self._lock:
+            self._merge(self._read())
+            tmp_path = self._path + '.' + str(uuid4())
+            with open(tmp_path, 'w') as fd:
+                json.dump(self._cache.items(), fd)
+            os.rename(tmp_path, self._path)
+
+    def stats(self):
+        """ Get the hit/miss/eviction counters and the current number of entries """
+        with self._lock:
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'size': len(self._cache)
+            }
+
+    def _read(self):
+        """ Read the entries persisted on disk, if there are any """
+        try:
+            with open(self._path) as fd:
+                return json.load(fd)
+        except (IOError, ValueError):
+            return []
+
+    def _merge(self, items):
+        """ Add persisted entries that are newer than the ones we already have """
+        for (digest, (shock_id, intime)) in items:
+            entry = self._cache.get(digest)
+            if not entry or entry[1] < intime:
+                self._cache.pop(digest, None)
+                self._cache[digest] = [shock_id, intime]
+        # Keep the entries ordered by the time they were added
+        self._cache = OrderedDict(sorted(self._cache.items(), key=lambda (_, v): v[1]))
+        # Entries from disk may already have been evicted here, so these are not counted
+        self._evict()
+
+    def _evict(self):
+        """
+        Drop expired entries and the oldest entries above the maximum size
+        :return: number of entries that were dropped
+        """
+        expiry = _time.time() - self._max_age_sec
+        count = 0
+        while self._cache:
+            (digest, (_, intime)) = next(self._cache.iteritems())
+            if len(self._cache) <= self._maxsize and intime >= expiry:
+                break
+            del self._cache[digest]
+            count += 1
+        return count
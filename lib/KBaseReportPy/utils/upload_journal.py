@@ -0,0 +1,120 @@
+# -*- coding: utf-8 -*-
+import hashlib
+import json
+import os
+import threading as _threading
+import time as _time
+
+"""
+On-disk journals of the uploads done for a report
+Each upload is appended to the journal as soon as it finishes, so when creating a report fails
+part of the way through (such as on a callback timeout), a retry with the same idempotency key
+only uploads the paths that are missing or have changed since
+"""
+
+
+class UploadJournal(object):
+    ''' An append-only file of the shock info uploaded for each path of a report. '''
+
+    def __init__(self, path):
+        """
+        :param path: file holding the journal, which is created by the first upload
+        """
+        self.path = path
+        self._lock = _threading.Lock()
+        # (path, pack, name) -> [mtime, size, shock info]
+        self._entries = {}
+        self.hits = 0
+        try:
+            with open(path) as fd:
+                for line in fd:
+                    try:
+                        entry = json.loads(line)
+                    except ValueError:
+                        # The last line may have been cut off by a crash
+                        continue
+                    key = (entry['path'], entry['pack'], entry['name'])
+                    self._entries[key] = [entry['mtime'], entry['size'], entry['shock']]
+        except IOError:
+            pass
+
+    def get(self, manifest, pack, name):
+        """
+        Get the shock info recorded for a path, if it has not changed since it was uploaded
+        :param manifest: Manifest of the uploaded file or directory (see ./dir_scan.py)
+        :param pack: the file_to_shock 'pack' parameter used for the upload
+        :param name: name of the link, which zipped single files are stored under
+        :return: shock info returned by DataFileUtil, or None
+        """
+        entry = self._entries.get((os.path.abspath(manifest.path), pack, name))
+        if entry is None or entry[:2] != [manifest.mtime, manifest.size]:
+            return None
+        with self._lock:
+            self.hits += 1
+        return entry[2]
+
+    def add(self, manifest, pack, name, shock):
+        """ Record the shock info uploaded for a path (see get) """
+        entry = {'path': os.path.abspath(manifest.path), 'pack': pack, 'name': name,
+                 'mtime': manifest.mtime, 'size': manifest.size, 'shock': shock}
+        line = json.dumps(entry) + '\n'
+        with self._lock:
+            self._entries[(entry['path'], pack, name)] = [manifest.mtime, manifest.size, shock]
+            with open(self.path, 'a') as fd:
+                fd.write(line)
+                fd.flush()
+                os.fsync(fd.fileno())
+
+    def remove(self):
+        """ Delete the journal, once the report it was for has been saved """
+        try:
+            os.remove(self.path)
+        except OSError:
+            pass
+
+
+def open_journal(directory, user_id, params, key=None):
+    """
+    Open the journal for a report
+    :param directory: directory holding every journal; created if it doesn't exist
+    :param user_id: user creating the report. Journals are never shared between users.
+    :param params: create_extended_report parameters, from which the key is derived when
+        `key` is not given, so that a retry with the same parameters resumes the same journal
+    :param key: optional idempotency key given by the caller
+    :return: UploadJournal
+    """
+    if key is None:
+        key = json.dumps(dict((k, v) for (k, v) in params.items() if k != 'debug'),
+                         sort_keys=True)
+    digest = hashlib.sha256()
+    for text in (user_id or '', key):
+        digest.update(text.encode('utf-8') + '\0')
+    try:
+        os.makedirs(directory)
+    except OSError:
+        if not os.path.isdir(directory):
+            raise
+    return UploadJournal(os.path.join(directory, digest.hexdigest() + '.jsonl'))
+
+
+def remove_expired(directory, max_age_sec):
+    """
+    Delete journals that have not been written to in `max_age_sec` seconds
+    :return: number of journals deleted
+    """
+    try:
+        names = os.listdir(directory)
+    except OSError:
+        return 0
+    expiry = _time.time() - max_age_sec
+    count = 0
+    for name in names:
+        path = os.path.join(directory, name)
+        try:
+            if os.path.getmtime(path) < expiry:
+                os.remove(path)
+                count += 1
+        except OSError:
+            # Removed by another process
+            pass
+    return count
@@ -1,8 +1,11 @@
 # -*- coding: utf-8 -*-
 import os
+import threading as _threading
 from cerberus import Validator
 import pprint
 
+from fast_validation import compile_schema
+
 pp = pprint.PrettyPrinter(indent=4)
 
 """
@@ -10,72 +13,53 @@ Utilities for validating parameters
 We use the `cerberus` schema validation library: http://docs.python-cerberus.org
 """
 
+# Validators for each thread, by schema name (see _get_validator)
+_validators = _threading.local()
+
 
 def validate_simple_report_params(params):
     """ Validate all parameters to KBaseReportPyImpl#create """
-    validator = Validator({
-        'workspace_name': {'type': 'string', 'minlength': 1},
-        'workspace_id': {'type': 'integer', 'min': 0},
-        'report': {
-            'type': 'dict',
-            'required': True,
-            'schema': {
-                'text_message': {'type': 'string'},
-                'warnings': {
-                    'type': 'list',
-                    'schema': {'type': 'string'}
-                },
-                'objects_created': {
-                    'type': 'list',
-                    'schema': object_created_schema
-                },
-                'direct_html': {
-                    'type': 'string'
-                }
-            }
-        }
-    })
+    validator = _get_validator('simple_report', simple_report_schema)
     _require_workspace_id_or_name(params)
     if not validator.validate(params):
-        raise TypeError(_format_errors(validator.errors, params))
+        raise TypeError(_format_errors(_flatten_errors(validator.errors), params))
     return params
 
 
-def validate_extended_report_params(params):
-    """ Validate all parameters to KBaseReportPyImpl#create_extended_report """
-    validator = Validator({
-        'workspace_name': {'type': 'string', 'minlength': 1},
-        'workspace_id': {'type': 'integer', 'min': 0},
-        'message': {'type': 'string'},
-        'objects_created': {
-            'type': 'list',
-            'schema': object_created_schema,
-        },
-        'warnings': {
-            'type': 'list',
-            'schema': {'type': 'string'}
-        },
-        'html_links': {
-            'type': 'list',
-            'schema': extended_file_schema
-        },
-        'file_links': {
-            'type': 'list',
-            'schema': extended_file_schema
-        },
-        'report_object_name': {'type': 'string'},
-        'html_window_height': {'type': 'integer', 'min': 1},
-        'summary_window_height': {'type': 'integer', 'min': 1},
-        'direct_html_link_index': {'type': 'integer', 'min': 0},
-        'direct_html': {'type': 'string'}
-    })
+def validate_extended_report_params(params, fast=False):
+    """
+    Validate all parameters to KBaseReportPyImpl#create_extended_report
+    :param fast: check the schema with the single-pass validator from ./fast_validation.py
+        instead of cerberus. Both report the same errors.
+    """
     _validate_html_index(params.get('html_links', []), params.get('direct_html_link_index'))
     _require_workspace_id_or_name(params)
-    if not validator.validate(params):
-        raise TypeError(_format_errors(validator.errors, params))
+    _require_name_if_idempotent(params)
+    errors = _extended_report_errors(params, fast)
+    if errors:
+        raise TypeError(_format_errors(errors, params))
     return params
 
 
+def validate_extended_reports_params(params_list, fast=False):
+    """
+    Validate all parameters to KBaseReportPyImpl#create_extended_reports
+    Every report is validated before any of them are created. Errors name the index of the
+    report that failed, and are raised with the same exception type as for a single report.
+    :param fast: use the fast validator (see validate_extended_report_params)
+    """
+    if not isinstance(params_list, list):
+        raise TypeError("KBaseReport parameter validation errors:\n"
+                        " * params: must be of list type\n")
+    for (idx, params) in enumerate(params_list):
+        try:
+            validate_extended_report_params(params, fast)
+            _reject_single_report_params(params)
+        except (TypeError, ValueError, IndexError) as err:
+            raise type(err)("Report at index " + str(idx) + ": " + str(err))
+    return params_list
+
+
 def validate_files(files):
     """
     Validate that every entry in `files` contains either a "shock_id" or "path"
@@ -92,6 +76,66 @@ def validate_files(files):
             raise ValueError(_format_errors(err, f))
 
 
+def validate_report_size(params, size, max_bytes=0, max_files=0):
+    """
+    Raise an exception if the paths of a report add up to more than `max_bytes` bytes or
+    `max_files` files. A limit of 0 is no limit.
+    :param params: parameters of the report, shown in the error
+    :param size: the report's size, from file_utils.estimate_size
+    """
+    errors = {}
+    if max_bytes and size['bytes'] > max_bytes:
+        errors['file_links, html_links'] = [
+            'paths hold %d bytes, more than the limit of %d' % (size['bytes'], max_bytes)]
+    if max_files and size['files'] > max_files:
+        errors.setdefault('file_links, html_links', []).append(
+            'paths hold %d files, more than the limit of %d' % (size['files'], max_files))
+    if errors:
+        raise ValueError(_format_errors(errors, params))
+
+
+def _get_validator(name, schema):
+    """
+    Get a validator for one of the schemas below, building it only once per thread
+    Validators keep the state of the document they are validating, so they can't be shared
+    between threads, but re-using them skips normalizing the schema on every request
+    """
+    validator = getattr(_validators, name, None)
+    if validator is None:
+        validator = Validator(schema)
+        setattr(_validators, name, validator)
+    return validator
+
+
+def _extended_report_errors(params, fast=False):
+    """
+    Check extended report parameters against extended_report_schema
+    :return: dict of error messages by the dotted path to each invalid value
+    """
+    if fast:
+        return _fast_extended_report_validator(params)
+    validator = _get_validator('extended_report', extended_report_schema)
+    if validator.validate(params):
+        return {}
+    return _flatten_errors(validator.errors)
+
+
+def _flatten_errors(errors, prefix=''):
+    """
+    Flatten nested cerberus errors, such as {'file_links': [{0: [{'name': [msg]}]}]},
+    into lists of messages keyed by dotted paths, such as {'file_links.0.name': [msg]}
+    """
+    flat = {}
+    for (key, messages) in errors.items():
+        key = prefix + str(key)
+        for message in messages:
+            if isinstance(message, dict):
+                flat.update(_flatten_errors(message, key + '.'))
+            else:
+                flat.setdefault(key, []).append(message)
+    return flat
+
+
 def _require_workspace_id_or_name(params):
     """
     We need either workspace_id or workspace_name, but we don't need both
@@ -106,6 +150,28 @@ def _require_workspace_id_or_name(params):
     return params
 
 
+def _require_name_if_idempotent(params):
+    """
+    Reports are only found again by their name, so idempotent mode needs report_object_name
+    """
+    if params.get('idempotent') and 'report_object_name' not in params:
+        err = {'report_object_name': ['required when idempotent is set']}
+        raise TypeError(_format_errors(err, params))
+    return params
+
+
+def _reject_single_report_params(params):
+    """
+    Retries are only made safe for a single report, so rather than ignoring idempotency_key and
+    idempotent in a batch, where callers would think their retries are safe, reject them
+    """
+    err = dict((key, ['not supported by create_extended_reports'])
+               for key in ('idempotency_key', 'idempotent') if key in params)
+    if err:
+        raise TypeError(_format_errors(err, params))
+    return params
+
+
 def _validate_html_index(html_links, index):
     """
     Validate that the main file (html_link['name']) is present inside the html directory
@@ -187,3 +253,61 @@ extended_file_schema = {
         'description': {'type': 'string'}
     }
 }
+
+# Parameters for KBaseReportPyImpl#create
+simple_report_schema = {
+    'workspace_name': {'type': 'string', 'minlength': 1},
+    'workspace_id': {'type': 'integer', 'min': 0},
+    'report': {
+        'type': 'dict',
+        'required': True,
+        'schema': {
+            'text_message': {'type': 'string'},
+            'warnings': {
+                'type': 'list',
+                'schema': {'type': 'string'}
+            },
+            'objects_created': {
+                'type': 'list',
+                'schema': object_created_schema
+            },
+            'direct_html': {
+                'type': 'string'
+            }
+        }
+    }
+}
+
+# Parameters for KBaseReportPyImpl#create_extended_report
+extended_report_schema = {
+    'workspace_name': {'type': 'string', 'minlength': 1},
+    'workspace_id': {'type': 'integer', 'min': 0},
+    'message': {'type': 'string'},
+    'objects_created': {
+        'type': 'list',
+        'schema': object_created_schema,
+    },
+    'warnings': {
+        'type': 'list',
+        'schema': {'type': 'string'}
+    },
+    'html_links': {
+        'type': 'list',
+        'schema': extended_file_schema
+    },
+    'file_links': {
+        'type': 'list',
+        'schema': extended_file_schema
+    },
+    'report_object_name': {'type': 'string'},
+    'html_window_height': {'type': 'integer', 'min': 1},
+    'summary_window_height': {'type': 'integer', 'min': 1},
+    'direct_html_link_index': {'type': 'integer', 'min': 0},
+    'direct_html': {'type': 'string'},
+    'debug': {'type': 'integer'},
+    'idempotency_key': {'type': 'string'},
+    'idempotent': {'type': 'integer'}
+}
+
+# Single-pass validator for the same schema (see ./fast_validation.py)
+_fast_extended_report_validator = compile_schema(extended_report_schema)
@@ -0,0 +1,53 @@
+# -*- coding: utf-8 -*-
+import threading as _threading
+import time as _time
+from collections import OrderedDict
+
+"""
+An in-process cache of workspace name to workspace ID lookups
+Saves a DataFileUtil.ws_name_to_id round trip for every report saved to a workspace we've seen
+"""
+
+
+class WorkspaceIdCache(object):
+    ''' A size-limited map from workspace name to ID whose entries expire. '''
+
+    def __init__(self, maxsize=1000, ttl_sec=5 * 60):
+        """
+        :param maxsize: maximum number of workspace names to keep; the oldest are evicted first
+        :param ttl_sec: number of seconds after which a workspace name is looked up again
+        """
+        self._maxsize = maxsize
+        self._ttl_sec = ttl_sec
+        self._lock = _threading.RLock()
+        # Ordered from oldest to newest: name -> [workspace_id, time added]
+        self._cache = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get_id(self, name, lookup):
+        """
+        Get the ID for a workspace name, calling `lookup(name)` if it isn't cached
+        :param name: workspace name
+        :param lookup: function that fetches the ID for a workspace name
+        :return: workspace ID
+        """
+        with self._lock:
+            entry = self._cache.get(name)
+            if entry and _time.time() - entry[1] <= self._ttl_sec:
+                self.hits += 1
+                return entry[0]
+            self.misses += 1
+        # Don't hold the lock during the round trip
+        ws_id = lookup(name)
+        with self._lock:
+            self._cache.pop(name, None)
+            self._cache[name] = [ws_id, _time.time()]
+            while len(self._cache) > self._maxsize:
+                self._cache.popitem(last=False)
+        return ws_id
+
+    def stats(self):
+        """ Get the number of lookups saved (hits), made (misses), and cached names """
+        with self._lock:
+            return {'hits': self.hits, 'misses': self.misses, 'size': len(self._cache)}
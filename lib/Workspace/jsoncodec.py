@@ -0,0 +1,83 @@
+'''
+JSON encoding and decoding for the KBase server and clients, using the
+fastest installed backend and falling back to the standard library.
+
+Encoding uses simplejson when it is installed. ujson is only used for
+decoding, because the releases that support Python 2 round floats when
+encoding. Set the KB_JSON_CODEC environment variable to a backend name
+(json, simplejson or ujson) to use only that backend, which must be
+installed. As ujson is never used for encoding, KB_JSON_CODEC=ujson
+decodes with ujson and encodes with json.
+
+Both directions behave like the standard library's json module. Sets and
+frozensets are encoded as lists, and objects with a toJSONable() method
+are encoded as what it returns.
+'''
+import json as _json
+import os as _os
+
+try:
+    import simplejson as _simplejson
+except ImportError:
+    _simplejson = None
+
+try:
+    import ujson as _ujson
+except ImportError:
+    _ujson = None
+
+
+def _default(obj):
+    if isinstance(obj, (set, frozenset)):
+        return list(obj)
+    if hasattr(obj, 'toJSONable'):
+        return obj.toJSONable()
+    raise TypeError(repr(obj) + ' is not JSON serializable')
+
+
+# Backends as (name, function), fastest first
+_ENCODERS = []
+_DECODERS = []
+if _simplejson is not None:
+    _ENCODERS.append(('simplejson', lambda obj: _simplejson.dumps(
+        obj, default=_default, namedtuple_as_object=False, use_decimal=False)))
+_ENCODERS.append(('json', lambda obj: _json.dumps(obj, default=_default)))
+if _ujson is not None:
+    _DECODERS.append(('ujson', lambda text: _ujson.loads(text, precise_float=True)))
+if _simplejson is not None:
+    _DECODERS.append(('simplejson', _simplejson.loads))
+_DECODERS.append(('json', _json.loads))
+
+
+def _choose(backends, preferred):
+    if not preferred:
+        return backends[0]
+    for backend in backends:
+        if backend[0] == preferred:
+            return backend
+    if preferred in ('json', 'simplejson', 'ujson'):
+        raise ImportError('KB_JSON_CODEC is ' + preferred +
+                          ', which is not installed')
+    raise ValueError('KB_JSON_CODEC must be json, simplejson or ujson, not ' +
+                     preferred)
+
+
+_PREFERRED = _os.environ.get('KB_JSON_CODEC')
+(DECODER, _loads) = _choose(_DECODERS, _PREFERRED)
+(ENCODER, _dumps) = _choose(
+    _ENCODERS, 'json' if _PREFERRED == 'ujson' else _PREFERRED)
+
+
+def dumps(obj):
+    '''
+    Encode an object as a JSON string.
+    '''
+    return _dumps(obj)
+
+
+def loads(text):
+    '''
+    Decode a JSON string or UTF-8 encoded bytes. Raises a ValueError for
+    invalid JSON, whatever the backend.
+    '''
+    return _loads(text)
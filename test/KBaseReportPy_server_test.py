@@ -1,8 +1,12 @@
 # -*- coding: utf-8 -*-
 import unittest
 import os
+import json
 import time
 import shutil
+import sys
+import threading
+import zipfile
 
 from DataFileUtil.DataFileUtilClient import DataFileUtil
 
@@ -15,9 +19,14 @@ except:
 from pprint import pprint  # noqa: F401
 
 from biokbase.workspace.client import Workspace as workspaceService
+from KBaseReportPy import jsoncodec
 from KBaseReportPy.KBaseReportPyImpl import KBaseReportPy
-from KBaseReportPy.KBaseReportPyServer import MethodContext
-from KBaseReportPy.authclient import KBaseAuth as _KBaseAuth
+from KBaseReportPy.KBaseReportPyServer import MethodContext, application, JSONRPCServiceCustom
+from KBaseReportPy.authclient import KBaseAuth as _KBaseAuth, SqliteTokenCache, TokenCache
+from KBaseReportPy.utils import async_utils, dir_scan, file_utils, pack_utils, upload_journal
+from KBaseReportPy.utils import validation_utils
+from KBaseReportPy.utils.report_ref_cache import ReportRefCache
+from KBaseReportPy.utils.timing_utils import StageTimer
 from uuid import uuid4
 
 
@@ -36,9 +45,8 @@ class KBaseReportPyTest(unittest.TestCase):
         authServiceUrl = cls.cfg['auth-service-url']
         auth_client = _KBaseAuth(authServiceUrl)
         user_id = auth_client.get_user(token)
-        # WARNING: don't call any logging methods on the context object,
-        # it'll result in a NoneType error
-        cls.ctx = MethodContext(None)
+        # Log with the server's logger, as the Impl writes each report's timings to the job log
+        cls.ctx = MethodContext(application.userlog)
         cls.ctx.update({'token': token,
                         'user_id': user_id,
                         'provenance': [
@@ -152,6 +160,16 @@ class KBaseReportPyTest(unittest.TestCase):
         data = obj['data'][0]['data']
         self.assertEqual(data['text_message'], msg)
 
+    def test_create_workspace_id_cache(self):
+        """ Repeated reports to the same workspace name reuse the cached workspace ID """
+        params = {'workspace_name': self.getWsName(), 'report': {'text_message': 'x'}}
+        self.getImpl().create(self.getContext(), params)
+        hits = self.getImpl().status(self.getContext())[0]['workspace_id_cache']['hits']
+        result = self.getImpl().create(self.getContext(), params)
+        self.assertEqual(result[0]['ref'].split('/')[0], str(self.getWsID()))
+        stats = self.getImpl().status(self.getContext())[0]['workspace_id_cache']
+        self.assertEqual(stats['hits'], hits + 1)
+
     def test_create_param_errors(self):
         """
         See lib/KBaseReportPy/utils/validation_utils
@@ -177,6 +195,23 @@ class KBaseReportPyTest(unittest.TestCase):
             self.getImpl().create_extended_report(self.getContext(), {'workspace_name': 123})
         self.assertTrue(str(err.exception))
 
+    def test_fast_validation_matches_cerberus(self):
+        """ The fast extended report validator reports the same errors as cerberus """
+        cases = [
+            {'workspace_id': 1, 'message': 'x', 'file_links': [{'name': 'a', 'path': 'a'}]},
+            {'workspace_id': -1, 'workspace_name': '', 'message': 1, 'unknown': 1},
+            {
+                'workspace_name': 'x',
+                'file_links': [{'name': 1, 'path': None, 'unknown': 1}, 'x'],
+                'objects_created': [{}, {'ref': ''}],
+                'warnings': 'x'
+            },
+            {'workspace_id': 1.5, 'html_links': {}, 'html_window_height': 0, 'warnings': [1]}
+        ]
+        for params in cases:
+            self.assertEqual(validation_utils._extended_report_errors(params, fast=True),
+                             validation_utils._extended_report_errors(params, fast=False))
+
     def test_invalid_file_links(self):
         """ Test a file link path where the file is non-existent """
         file = {
@@ -212,6 +247,328 @@ class KBaseReportPyTest(unittest.TestCase):
         })
         self.check_extended_result(result, 'file_links', ['a', 'b'])
 
+    def test_create_extended_report_submit(self):
+        """ Create a report in the background and poll for its progress and result """
+        job_id = self.getImpl().create_extended_report_submit(self.getContext(), {
+            'workspace_name': self.getWsName(),
+            'file_links': [{'name': 'a', 'path': self.a_file_path},
+                           {'name': 'b', 'shock_id': self.b_file_shock['shock_id']}]
+        })[0]
+        for _ in range(120):
+            job = self.getImpl().check_report_job(self.getContext(), job_id)[0]
+            if job['status'] in ('completed', 'error'):
+                break
+            time.sleep(0.5)
+        self.assertEqual(job['status'], 'completed', job.get('error'))
+        self.assertEqual((job['files_done'], job['files_total']), (2, 2))
+        self.assertEqual(job['bytes_done'], os.path.getsize(self.a_file_path))
+        self.assertEqual(job['bytes_total'], job['bytes_done'])
+        self.check_extended_result([job['result']], 'file_links', ['a', 'b'])
+        # The result is only returned once
+        with self.assertRaises(ValueError):
+            self.getImpl().check_report_job(self.getContext(), job_id)
+
+    def test_create_extended_report_file_order(self):
+        """ Concurrent uploads keep the order of file_links in the saved report """
+        names = ['file_' + str(i) for i in range(10)]
+        file_links = [
+            {'name': name, 'path': (self.a_file_path if i % 2 else self.b_file_path)}
+            for (i, name) in enumerate(names)
+        ]
+        result = self.getImpl().create_extended_report(self.getContext(), {
+            'workspace_name': self.getWsName(),
+            'report_object_name': 'my_report',
+            'file_links': file_links
+        })
+        obj = self.dfu.get_objects({'object_refs': [result[0]['ref']]})
+        saved_names = [f['name'] for f in obj['data'][0]['data']['file_links']]
+        self.assertEqual(saved_names, names)
+
+    def test_create_extended_report_debug_timings(self):
+        """ Test that the debug parameter returns the time spent in each stage """
+        # Workspace lookups and uploads may be cached by earlier tests, so only the stages that
+        # always run are checked
+        result = self.getImpl().create_extended_report(self.getContext(), {
+            'workspace_id': self.getWsID(),
+            'file_links': [{'name': 'a', 'path': self.a_file_path}],
+            'debug': 1
+        })
+        debug = result[0]['debug']
+        for stage in ['validate', 'workspace_id', 'upload', 'save', 'save_objects', 'total']:
+            self.assertIn(stage, debug)
+        self.assertLessEqual(debug['save_objects'], debug['total'])
+        status = self.getImpl().status(self.getContext())[0]
+        self.assertGreaterEqual(status['stage_timings']['total']['count'], 1)
+
+    def test_metrics_endpoint(self):
+        """ Test that the server renders its metrics and the report metrics for GET /metrics """
+        statuses = []
+        body = ''.join(application({'REQUEST_METHOD': 'GET', 'PATH_INFO': '/metrics'},
+                                   lambda status, headers: statuses.append(status)))
+        self.assertEqual(statuses, ['200 OK'])
+        self.assertIn('# TYPE kbase_report_requests_total counter', body)
+        self.assertIn('kbase_report_requests_in_flight 0', body)
+        self.assertIn('kbase_report_auth_cache_hit_ratio', body)
+        self.assertIn('# TYPE kbase_report_files histogram', body)
+        # Other tests may have uploaded files through the same server, so any value will do
+        self.assertIn('\nkbase_report_uploaded_bytes_total ', body)
+
+    def test_token_cache(self):
+        """ Test that the token cache evicts the least recently used token and expires tokens """
+        cache = TokenCache(maxsize=2)
+        cache.add_valid_token('token_a', 'user_a')
+        cache.add_valid_token('token_b', 'user_b')
+        self.assertEqual(cache.get_user('token_a'), 'user_a')
+        # token_b is now the least recently used
+        cache.add_valid_token('token_c', 'user_c')
+        self.assertIsNone(cache.get_user('token_b'))
+        self.assertEqual(cache.get_user('token_c'), 'user_c')
+        cache._MAX_TIME_SEC = -1
+        cache.add_valid_token('token_d', 'user_d')
+        self.assertIsNone(cache.get_user('token_d'))
+        self.assertEqual(cache.stats(), {'hits': 2, 'misses': 2, 'evictions': 3, 'size': 1})
+
+    def test_shared_token_cache(self):
+        """ Test that auth clients sharing a token cache file only validate a token once """
+        cache_path = os.path.join(self.scratch, 'tokens_' + str(uuid4()) + '.sqlite')
+        first = _KBaseAuth(self.cfg['auth-service-url'], SqliteTokenCache(cache_path))
+        second = _KBaseAuth(self.cfg['auth-service-url'], SqliteTokenCache(cache_path))
+        user_id = self.getContext()['user_id']
+        self.assertEqual(first.get_user(self.getContext()['token']), user_id)
+        self.assertEqual(second.get_user(self.getContext()['token']), user_id)
+        self.assertEqual(second.cache_stats()['hits'], 1)
+        self.assertEqual(second.cache_stats()['size'], 1)
+
+    def test_token_validation_single_flight(self):
+        """ Test that concurrent lookups of a new token share a single validation """
+        auth_client = _KBaseAuth(self.cfg['auth-service-url'])
+        users = []
+        threads = [threading.Thread(target=lambda: users.append(
+            auth_client.get_user(self.getContext()['token']))) for _ in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(users, [self.getContext()['user_id']] * 8)
+        stats = auth_client.cache_stats()
+        # Every miss except the one that validated the token waited on it
+        self.assertEqual(stats['misses'] - stats['coalesced'], 1)
+
+    def test_request_body_too_large(self):
+        """ Test that an oversized request body gets a parse error without being read """
+        class UnreadableInput(object):
+            def read(self, size=-1):
+                raise AssertionError('The request body should not be read')
+        statuses = []
+        body = ''.join(application({
+            'REQUEST_METHOD': 'POST',
+            'REMOTE_ADDR': '127.0.0.1',
+            'CONTENT_LENGTH': str(application.max_body_size + 1),
+            'wsgi.input': UnreadableInput()
+        }, lambda status, headers: statuses.append(status)))
+        self.assertEqual(statuses, ['500 Internal Server Error'])
+        error = json.loads(body)['error']
+        self.assertEqual(error['code'], -32700)
+        self.assertIn('larger than the maximum', error['message'])
+
+    def test_concurrent_batch_requests(self):
+        """ Test that batch calls run on a pool, keep their order, and fail independently """
+        service = JSONRPCServiceCustom(batch_workers=4)
+
+        def slow_echo(ctx, value):
+            time.sleep(0.5)
+            if value == 'fail':
+                raise ValueError('Failed on purpose')
+            return [value]
+        service.add(slow_echo, name='Test.slow_echo', types=[basestring])
+        batch = [{'method': 'Test.slow_echo', 'params': [value], 'version': '1.1', 'id': str(idx)}
+                 for (idx, value) in enumerate(['a', 'fail', 'c', 'd'])]
+        start = time.time()
+        responses = service.call_py(self.getContext(), batch)
+        self.assertLess(time.time() - start, 1.5)
+        self.assertEqual([r['id'] for r in responses], ['0', '1', '2', '3'])
+        self.assertEqual([r.get('result') for r in responses], [['a'], None, ['c'], ['d']])
+        self.assertIn('Failed on purpose', responses[1]['error']['message'])
+
+    def test_json_codec(self):
+        """ Test that every JSON backend encodes sets and toJSONable objects the same way """
+        class Point(object):
+            def toJSONable(self):
+                return {'x': 1.1, 'y': [2]}
+        obj = {'set': set(['a']), 'frozenset': frozenset([1]), 'point': Point(), 'text': u'\xb0'}
+        expected = {'set': ['a'], 'frozenset': [1], 'point': {'x': 1.1, 'y': [2]}, 'text': u'\xb0'}
+        for (_, dumps) in jsoncodec._ENCODERS:
+            self.assertEqual(json.loads(dumps(obj)), expected)
+        for (_, loads) in jsoncodec._DECODERS:
+            self.assertEqual(loads(json.dumps(expected)), expected)
+            with self.assertRaises(ValueError):
+                loads('{"unterminated": ')
+        with self.assertRaises(TypeError):
+            jsoncodec.dumps(object())
+
+    def test_create_extended_report_upload_cache(self):
+        """ Re-attaching an identical file reuses its shock node from the upload cache """
+        params = {
+            'workspace_name': self.getWsName(),
+            'report_object_name': 'my_report',
+            'file_links': [{'name': 'a', 'path': self.a_file_path}]
+        }
+        self.getImpl().create_extended_report(self.getContext(), params)
+        hits = self.getImpl().status(self.getContext())[0]['upload_cache']['hits']
+        result = self.getImpl().create_extended_report(self.getContext(), params)
+        self.check_extended_result(result, 'file_links', ['a'])
+        stats = self.getImpl().status(self.getContext())[0]['upload_cache']
+        self.assertEqual(stats['hits'], hits + 1)
+
+    def test_create_extended_report_resumes_journal(self):
+        """ A retry with the same idempotency key reuses the uploads recorded in its journal """
+        params = {
+            'workspace_name': self.getWsName(),
+            'idempotency_key': str(uuid4()),
+            'file_links': [{'name': 'a', 'path': self.a_file_path},
+                           {'name': 'b', 'path': self.b_file_path}]
+        }
+        # Record the upload of the first file, as a failed attempt would have
+        journal = upload_journal.open_journal(self.getImpl().upload_journal_dir,
+                                              self.getContext()['user_id'], params,
+                                              params['idempotency_key'])
+        shock = self.dfu.file_to_shock({'file_path': self.a_file_path, 'make_handle': 1})
+        journal.add(dir_scan.scan(self.a_file_path), None, 'a', shock)
+        result = self.getImpl().create_extended_report(self.getContext(), params)
+        self.check_extended_result(result, 'file_links', ['a', 'b'])
+        obj = self.dfu.get_objects({'object_refs': [result[0]['ref']]})
+        self.assertEqual(obj['data'][0]['data']['file_links'][0]['handle'],
+                         shock['handle']['hid'])
+        # The journal is removed once the report is saved
+        self.assertFalse(os.path.exists(journal.path))
+
+    def test_create_extended_report_idempotent(self):
+        """ Retrying an idempotent report returns the saved report until its files change """
+        params = {
+            'workspace_name': self.getWsName(),
+            'report_object_name': 'idempotent_' + str(uuid4()),
+            'idempotent': 1,
+            'file_links': [{'name': 'a', 'path': self.a_file_path}]
+        }
+        ref = self.getImpl().create_extended_report(self.getContext(), params)[0]['ref']
+        retry = self.getImpl().create_extended_report(self.getContext(), params)[0]
+        self.assertEqual(retry['ref'], ref)
+        # A new server process finds the report in the workspace instead of in its cache
+        self.getImpl().report_ref_cache = ReportRefCache()
+        retry = self.getImpl().create_extended_report(self.getContext(), params)[0]
+        self.assertEqual(retry['ref'], ref)
+        # Different params save a new version
+        changed = self.getImpl().create_extended_report(self.getContext(),
+                                                        dict(params, message='changed'))[0]
+        self.assertNotEqual(changed['ref'], ref)
+        with self.assertRaises(TypeError):
+            self.getImpl().create_extended_report(self.getContext(), {
+                'workspace_name': self.getWsName(), 'idempotent': 1
+            })
+
+    def test_create_extended_report_size_limits(self):
+        """ Reports over max-report-bytes or max-report-files are rejected before uploading """
+        impl = self.getImpl()
+        # Sizes are logged by link name, which need not be ASCII
+        params = {
+            'workspace_name': self.getWsName(),
+            'html_links': [{'name': u'\xedndex.html', 'path': self.a_html_path}]
+        }
+        size = dir_scan.scan(self.a_html_path).size
+        self.addCleanup(setattr, impl, 'max_report_bytes', impl.max_report_bytes)
+        impl.max_report_bytes = size - 1
+        with self.assertRaises(ValueError) as err:
+            impl.create_extended_report(self.getContext(), params)
+        self.assertIn('more than the limit', str(err.exception))
+        with self.assertRaises(ValueError):
+            impl.create_extended_report_submit(self.getContext(), params)
+        impl.max_report_bytes = size
+        result = impl.create_extended_report(self.getContext(), params)
+        self.check_extended_result(result, 'html_links', [u'\xedndex.html'])
+
+    def test_create_extended_reports(self):
+        """ Create several reports in one call, keeping their order """
+        params = [
+            {
+                'workspace_name': self.getWsName(),
+                'report_object_name': 'bulk_report_a',
+                'file_links': [{'name': 'a', 'path': self.a_file_path}]
+            },
+            {
+                'workspace_id': self.getWsID(),
+                'report_object_name': 'bulk_report_b',
+                'html_links': [{'name': 'index.html', 'path': self.b_html_path}],
+                'direct_html_link_index': 0
+            }
+        ]
+        result = self.getImpl().create_extended_reports(self.getContext(), params)
+        self.assertEqual([info['name'] for info in result[0]],
+                         ['bulk_report_a', 'bulk_report_b'])
+        self.check_extended_result([result[0][0]], 'file_links', ['a'])
+        self.check_extended_result([result[0][1]], 'html_links', ['index.html'])
+
+    def test_run_steps_fails_fast(self):
+        """ A failed step is re-raised without waiting on independent steps or running others """
+        saved = []
+
+        def bad_workspace():
+            raise ValueError('No workspace')
+        steps = [
+            ('workspace_id', [], bad_workspace),
+            ('upload', [], lambda: time.sleep(5)),
+            ('save', ['workspace_id', 'upload'], lambda ws_id, files: saved.append(ws_id))
+        ]
+        timer = StageTimer()
+        cancel = threading.Event()
+        start = time.time()
+        with self.assertRaises(ValueError):
+            async_utils.run_steps(steps, timer, cancel)
+        self.assertLess(time.time() - start, 5)
+        self.assertEqual(saved, [])
+        # Steps that are still running are told to stop
+        self.assertTrue(cancel.is_set())
+        self.assertIn('workspace_id', timer.breakdown())
+        # Exceptions that aren't an Exception are re-raised too, rather than waited on forever
+        with self.assertRaises(SystemExit):
+            async_utils.run_steps([('exit', [], lambda: sys.exit(1))])
+
+    def test_dir_scan_matches_walk(self):
+        """ A parallel scan lists the same files, in the same order, as a sorted os.walk """
+        expected = []
+        for (dirpath, dirnames, filenames) in os.walk(self.a_html_path):
+            dirnames.sort()
+            for filename in sorted(filenames):
+                path = os.path.join(dirpath, filename)
+                expected.append((os.path.relpath(path, self.a_html_path), os.path.getsize(path)))
+        scanner = dir_scan.DirScanner(max_workers=4)
+        manifest = scanner.scan(self.a_html_path)
+        self.assertTrue(manifest.isdir)
+        self.assertEqual([(relpath, size) for (relpath, size, _, _) in manifest.files], expected)
+        self.assertEqual(manifest.size, sum(size for (_, size) in expected))
+        self.assertFalse(manifest.has_digests())
+        hashed = scanner.scan(self.a_html_path, digests=True)
+        self.assertEqual(hashed.files[0][3], dir_scan.file_digest(
+            os.path.join(self.a_html_path, hashed.files[0][0])))
+        # The scan is kept for the rest of the report
+        self.assertIs(scanner.scan(self.a_html_path), hashed)
+
+    def test_create_extended_reports_param_errors(self):
+        """ One invalid report fails the whole call before anything is created """
+        with self.assertRaises(TypeError) as err:
+            self.getImpl().create_extended_reports(self.getContext(), [
+                {'workspace_name': self.getWsName()},
+                {}
+            ])
+        self.assertIn('index 1', str(err.exception))
+        # Retries of a batch aren't made safe, so asking for it is an error
+        with self.assertRaises(TypeError) as err:
+            self.getImpl().create_extended_reports(self.getContext(), [{
+                'workspace_name': self.getWsName(),
+                'report_object_name': 'batch_report',
+                'idempotent': 1
+            }])
+        self.assertIn('not supported', str(err.exception))
+
     def test_create_extended_report_with_uploaded_files(self):
         result = self.getImpl().create_extended_report(self.getContext(), {
             'workspace_name': self.getWsName(),
@@ -231,6 +588,16 @@ class KBaseReportPyTest(unittest.TestCase):
         })
         self.check_extended_result(result, 'file_links', ['a', 'b'])
 
+    def test_create_extended_report_upload_error(self):
+        """ A failed DataFileUtil call names the link it failed for """
+        with self.assertRaises(file_utils.UploadError) as err:
+            self.getImpl().create_extended_report(self.getContext(), {
+                'workspace_name': self.getWsName(),
+                'file_links': [{'name': 'missing_node', 'shock_id': str(uuid4())}]
+            })
+        self.assertIn('"missing_node"', str(err.exception))
+        self.assertTrue(err.exception.cause)
+
     def test_create_extended_report_with_uploaded_html_files(self):
         result = self.getImpl().create_extended_report(self.getContext(), {
             'workspace_name': self.getWsName(),
@@ -288,6 +655,14 @@ class KBaseReportPyTest(unittest.TestCase):
         })
         self.check_extended_result(result, 'html_links', ['index.html', 'b'])
 
+    def test_zip_file_without_name(self):
+        """ A single file linked without a name is zipped under its own basename """
+        zip_path = os.path.join(self.scratch, str(uuid4()) + '.zip')
+        pack_utils.zip_file(self.a_file_path, None, zip_path)
+        with zipfile.ZipFile(zip_path) as archive:
+            self.assertEqual(archive.namelist(), ['a.txt'])
+        os.remove(zip_path)
+
     def test_invalid_extended_report_with_html_paths(self):
         """ Test the case where they set a single HTML file as their 'path' """
         result = self.getImpl().create_extended_report(self.getContext(), {
@@ -0,0 +1,68 @@
+# -*- coding: utf-8 -*-
+"""
+Benchmark JSON encoding and decoding of large requests and responses
+Compares the previous stdlib json.JSONEncoder subclass against every backend that
+lib/KBaseReportPy/jsoncodec can use in this environment (simplejson and ujson are
+only listed when they are installed)
+
+Run from the repository root with:
+    PYTHONPATH=lib python test/benchmark_json.py
+"""
+import json
+import timeit
+
+from KBaseReportPy import jsoncodec
+
+
+class _JSONObjectEncoder(json.JSONEncoder):
+    """ The previous behavior of the server and clients """
+
+    def default(self, obj):
+        if isinstance(obj, (set, frozenset)):
+            return list(obj)
+        return json.JSONEncoder.default(self, obj)
+
+
+def save_objects_request(num_files):
+    """ A save_objects call for a report with `num_files` file_links and html_links """
+    links = [
+        {'handle': 'KBH_' + str(i), 'URL': 'https://kbase.us/services/shock-api/node/' + str(i),
+         'name': 'file_' + str(i) + '.txt', 'label': u'fichier n\xb0' + str(i),
+         'description': 'file ' + str(i), 'size': i * 1024}
+        for i in range(num_files)
+    ]
+    report = {
+        'text_message': 'benchmark',
+        'file_links': links,
+        'html_links': links,
+        'warnings': [],
+        'objects_created': [{'ref': '1/' + str(i) + '/1', 'description': 'object'}
+                            for i in range(num_files)],
+        'html_window_height': 512.5,
+        'summary_window_height': None
+    }
+    return {'method': 'DataFileUtil.save_objects', 'version': '1.1', 'id': '1234',
+            'params': [{'id': 1, 'objects': [{'type': 'KBaseReport.Report', 'data': report,
+                                              'name': 'report', 'meta': {}, 'hidden': 1}]}]}
+
+
+def main():
+    encoders = [('json.JSONEncoder', lambda obj: json.dumps(obj, cls=_JSONObjectEncoder))]
+    encoders += jsoncodec._ENCODERS
+    decoders = [('json.loads', json.loads)] + jsoncodec._DECODERS
+    print('jsoncodec uses %s to encode and %s to decode' % (jsoncodec.ENCODER, jsoncodec.DECODER))
+    for num_files in (10, 10000):
+        request = save_objects_request(num_files)
+        text = json.dumps(request)
+        number = 500 if num_files == 10 else 5
+        for (direction, backends, arg) in (('dumps', encoders, request),
+                                           ('loads', decoders, text)):
+            for (label, func) in backends:
+                func(arg)  # warm up
+                secs = min(timeit.repeat(lambda: func(arg), number=number, repeat=3)) / number
+                print('%5d file_links  %s %-17s %10.3f ms/call' %
+                      (num_files, direction, label, secs * 1000))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,60 @@
+# -*- coding: utf-8 -*-
+"""
+Benchmark the per-call latency of extended report parameter validation
+Compares building a new cerberus Validator on every call against the cached validators
+in lib/KBaseReportPy/utils/validation_utils, and against the fast single-pass validator
+
+Run from the repository root with:
+    PYTHONPATH=lib/KBaseReportPy python test/benchmark_validation.py
+"""
+import timeit
+
+from cerberus import Validator
+
+from utils import validation_utils
+
+
+def extended_params(num_files):
+    """ Extended report parameters with `num_files` file_links and objects_created """
+    return {
+        'workspace_id': 1,
+        'message': 'benchmark',
+        'objects_created': [
+            {'ref': '1/' + str(i) + '/1', 'description': 'object ' + str(i)}
+            for i in range(num_files)
+        ],
+        'file_links': [
+            {'shock_id': 'node_' + str(i), 'name': 'file_' + str(i), 'description': 'file'}
+            for i in range(num_files)
+        ]
+    }
+
+
+def uncached(params):
+    """ The previous behavior: build the validator from the schema on every call """
+    validator = Validator(validation_utils.extended_report_schema)
+    return validator.validate(params)
+
+
+def cached(params):
+    """ Validate with the per-thread validator that is only built once """
+    return validation_utils.validate_extended_report_params(params)
+
+
+def fast(params):
+    """ Validate with the single-pass validator from utils/fast_validation """
+    return validation_utils.validate_extended_report_params(params, fast=True)
+
+
+def main():
+    for num_files in (1, 1000):
+        params = extended_params(num_files)
+        number = 200 if num_files == 1 else 5
+        for (label, func) in (('uncached', uncached), ('cached', cached), ('fast', fast)):
+            func(params)  # warm up
+            secs = min(timeit.repeat(lambda: func(params), number=number, repeat=3)) / number
+            print('%5d file_links  %-9s %10.3f ms/call' % (num_files, label, secs * 1000))
+
+
+if __name__ == '__main__':
+    main()